@@ -0,0 +1,552 @@
+# (c)2022, Artfahrt Inc, Arthur van Hoff
+# Micro benchmarks for the chart tiler, run as:
+#   python3 src/chart_benchmark.py notes data/charts/.../San\ Francisco\ SEC.tif
+#   python3 src/chart_benchmark.py store www/tiles/sec 10
+#   python3 src/chart_benchmark.py encode www/tiles/sec 10
+#   python3 src/chart_benchmark.py palette data/charts/.../San\ Francisco\ SEC.tif
+#   python3 src/chart_benchmark.py pyramid www/tiles/sec 12
+#   python3 src/chart_benchmark.py coverage www/tiles/sec
+#   python3 src/chart_benchmark.py warp data/charts/.../San\ Francisco\ SEC.tif
+#   python3 src/chart_benchmark.py errors data/charts/.../ENR_H01.tif
+#   python3 src/chart_benchmark.py footprint data/charts/.../Anchorage\ SEC.tif
+#   python3 src/chart_benchmark.py threads data/charts/.../Anchorage\ SEC.tif
+#   python3 src/chart_benchmark.py composite www/tiles/sec 10
+#   python3 src/chart_benchmark.py plan
+#   python3 src/chart_benchmark.py incremental data/charts/.../San\ Francisco\ SEC.tif data/charts/.../Los\ Angeles\ SEC.tif
+#   python3 src/chart_benchmark.py checks data/charts/.../San\ Francisco\ SEC.tif
+
+import os, sys, time, subprocess, numpy, cv2, multiprocessing
+import settings, util, chart_tiler, tile_store
+
+# the chart of a file, named after it, and a level of the chart at its native zoom
+def open_chart(path, store=None):
+    cf = chart_tiler.ChartFile(os.path.splitext(os.path.basename(path))[0], path)
+    return cf, chart_tiler.MapLevel(store, 'benchmark', cf.zoom)
+
+#
+# Compare the per-scanline chart notes against the vectorized cuts
+#
+def benchmark_notes(path, tolerance=8):
+    cf, _ = open_chart(path)
+    if cf.name not in settings.chart_notes:
+        print(f"warning: no notes for {cf.name}")
+    chart_tiler.chart_cache = False
+
+    chart_tiler.vectorized_notes = False
+    cf.load_rgba()
+    tm = time.time()
+    cf.mask()
+    t1 = time.time() - tm
+    reference = cf.rgba[...,3].copy()
+
+    chart_tiler.vectorized_notes = True
+    cf.load_rgba()
+    tm = time.time()
+    cf.mask()
+    t2 = time.time() - tm
+
+    diff = numpy.abs(cf.rgba[...,3].astype('int16') - reference)
+    print(f"{cf}: scanlines {t1:.3f}s, vectorized {t2:.3f}s, speedup {t1/max(t2, 1e-6):.1f}x")
+    print(f"    alpha max diff {diff.max()}, {100*(diff > tolerance).sum()/diff.size:.4f}% of pixels differ by more than {tolerance}")
+
+    # the rows at the ends of the line notes, where the cuts start and stop, and the
+    # pixels cleared in those rows
+    for args in cf.expand_notes(cf.notes):
+        if args[0] in ('l-line', 'r-line'):
+            start, stop = (float(args[1]), float(args[2])), (float(args[3]), float(args[4]))
+            points = cf.note_points(start, stop)
+            rows = numpy.flatnonzero(~numpy.isnan(cf.line_rows(start, stop)))
+            if len(points) > 0 and len(rows) > 0:
+                ends = (int(points[:,1].min()), int(points[:,1].max()))
+                cleared = [((reference[y] == 0).sum(), (cf.rgba[y,:,3] == 0).sum()) for y in ends]
+                print(f"    {args[0]}: scanline rows {ends[0]}..{ends[1]}, vectorized rows {rows[0]}..{rows[-1]}, cleared {cleared[0][0]}/{cleared[0][1]} and {cleared[1][0]}/{cleared[1][1]} pixels in the end rows{'' if ends == (rows[0], rows[-1]) else ', DIFFERENT'}")
+
+#
+# Copy the tiles of one zoom level of a layer into each kind of tile store
+#
+def benchmark_store(src_path, zoom):
+    src = tile_store.DirectoryTileStore(src_path)
+    tiles = [(x, y, src.read(zoom, x, y)) for x, y in src.tiles(zoom)]
+    print(f"{src}: {len(tiles)} tiles at zoom {zoom}, {sum(len(data) for _, _, data in tiles)/(1024*1024):.1f}MB")
+
+    for store_type in ('dir', 'mbtiles'):
+        store = tile_store.open_store('benchmark', settings.tmp_dir, store_type)
+        store.clear()
+        tm = time.time()
+        for x, y, data in tiles:
+            store.write(zoom, x, y, data)
+        store.close()
+        t1 = time.time() - tm
+        tm = time.time()
+        count = sum(1 for _ in store.tiles(zoom))
+        t2 = time.time() - tm
+        print(f"{store}: write {len(tiles)/max(t1, 1e-6):.0f} tiles/s, list {count} tiles in {t2:.3f}s, {store.disk_usage()/(1024*1024):.1f}MB on disk")
+        print(f"    {tile_store.stats_str(store.stats)}")
+        store.clear()
+
+#
+# Encode the tiles of one zoom level of a layer in each tile format
+#
+def benchmark_encode(src_path, zoom, max_tiles=1000):
+    src = tile_store.DirectoryTileStore(src_path)
+    tiles = [src.read_tile(zoom, x, y) for x, y in list(src.tiles(zoom))[:max_tiles]]
+    print(f"{src}: {len(tiles)} tiles at zoom {zoom}, {sum(1 for tile in tiles if tile[:,:,3].all())} opaque")
+
+    for format in tile_store.formats:
+        stats = {}
+        error = 0
+        for tile in tiles:
+            encoded_format, data, seconds = tile_store.encode_tile(tile, format)
+            tile_store.add_stats(stats, {'tiles': 1, f"{encoded_format}_tiles": 1, f"{encoded_format}_bytes": len(data), f"{encoded_format}_time": seconds})
+            rgb = tile_store.decode_tile(data)[...,:3].astype('int16')
+            error = max(error, numpy.abs(rgb - tile[...,:3])[tile[...,3] == 255].max(initial=0))
+        total = sum(stats.get(f"{f}_bytes", 0) for f in tile_store.formats)
+        seconds = sum(stats.get(f"{f}_time", 0) for f in tile_store.formats)
+        print(f"{format}: {total/len(tiles)/1024:.1f}KB/tile, {len(tiles)/max(seconds, 1e-6):.0f} tiles/s, max error {error}")
+        for f in tile_store.formats:
+            n = stats.get(f"{f}_tiles", 0)
+            if n > 0:
+                print(f"    {f}: {n} tiles, {stats[f'{f}_bytes']/n/1024:.1f}KB/tile, {1000*stats[f'{f}_time']/n:.1f}ms/tile")
+
+#
+# Compare rgba and palette tiles of the opaque tiles of a chart at its native zoom
+#
+def benchmark_palette(path, max_tiles=500):
+    cf, level = open_chart(path)
+    chart_tiler.palette_tiles = True
+
+    stats = {}
+    ntiles = 0
+    tiles = cf.tile_list(level)
+    for i in numpy.linspace(0, len(tiles)-1, min(max_tiles, len(tiles))).astype(int):
+        rect = tiles[i][2]
+        win = cf.load_block([tiles[i]])
+        tm = time.time()
+        index = cf.extract_index(rect, win=win)
+        t1 = time.time() - tm
+        if index is None:
+            continue
+        tm = time.time()
+        tile = cf.extract_tile(rect, win=win)
+        t2 = time.time() - tm
+        format, data1, seconds1 = tile_store.encode_tile(index, 'png', cf.clut[:,:3])
+        format, data2, seconds2 = tile_store.encode_tile(tile, 'png')
+        tile_store.add_stats(stats, {'indexed_warp': t1, 'indexed_time': seconds1, 'indexed_bytes': len(data1), 'rgba_warp': t2, 'rgba_time': seconds2, 'rgba_bytes': len(data2)})
+        ntiles += 1
+
+    print(f"{cf}: {ntiles} opaque tiles at zoom {cf.zoom}")
+    for kind in ('rgba', 'indexed'):
+        print(f"    {kind}: warp {1000*stats[f'{kind}_warp']/ntiles:.1f}ms, encode {1000*stats[f'{kind}_time']/ntiles:.1f}ms, {stats[f'{kind}_bytes']/ntiles/1024:.1f}KB per tile")
+    print(f"    encode {stats['rgba_time']/stats['indexed_time']:.1f}x faster, {stats['rgba_bytes']/stats['indexed_bytes']:.1f}x smaller")
+
+#
+# Build the lower levels from one zoom level of a layer in one pass, with the
+# block pyramid of the tile pool
+#
+def benchmark_pyramid(src_path, zoom, depth=chart_tiler.pyramid_depth):
+    src = tile_store.DirectoryTileStore(src_path)
+    tiles = [(x, y, src.read(zoom, x, y)) for x, y in src.tiles(zoom)]
+    print(f"{src}: {len(tiles)} tiles at zoom {zoom}, {depth} levels")
+
+    store = tile_store.open_store('pyramid', settings.tmp_dir)
+    store.clear()
+    for x, y, data in tiles:
+        store.write(zoom, x, y, data)
+
+    tm = time.time()
+    counts = chart_tiler.build_pyramid(store, numpy.array([(x, y) for x, y, _ in tiles], dtype='int64').reshape(-1, 2), zoom, zoom - depth)
+    store.close()
+    seconds = time.time() - tm
+    print(f"build_pyramid: {seconds:.1f}s, {sum(counts.values())/max(seconds, 1e-6):.0f} tiles/s, {store.disk_usage()/(1024*1024):.1f}MB")
+    for z in range(zoom-1, zoom-depth-1, -1):
+        print(f"    zoom {z}: {counts.get(z, 0)} tiles")
+    store.clear()
+
+#
+# Restore the coverage of a layer by walking the tiles and from the saved index
+#
+def benchmark_coverage(src_path, max_zoom=chart_tiler.max_zoom):
+    store = tile_store.DirectoryTileStore(src_path)
+    tm = time.time()
+    coverage = chart_tiler.TileCoverage(max_zoom)
+    for zoom in range(max_zoom+1):
+        for tx, ty in store.tiles(zoom):
+            coverage.touch(zoom, tx, ty)
+    coverage.merge()
+    t1 = time.time() - tm
+    path = os.path.join(settings.tmp_dir, "benchmark.coverage.npz")
+    coverage.save(path)
+
+    tm = time.time()
+    loaded = chart_tiler.TileCoverage(max_zoom)
+    loaded.load(path)
+    t2 = time.time() - tm
+    ntiles = sum(coverage.count(zoom) for zoom in range(max_zoom+1))
+    print(f"{store}: {ntiles} tiles, walk {t1:.3f}s, index {1000*t2:.1f}ms, {os.path.getsize(path)/1024:.1f}KB")
+    print(f"    dense bitmaps {sum(4**zoom for zoom in range(max_zoom+1))/(1024*1024):.1f}MB, index {sum(codes.nbytes for codes in loaded.codes)/(1024*1024):.1f}MB")
+    os.remove(path)
+
+#
+# Warp the tiles of a chart at its native zoom one tile at a time, and in
+# groups of n x n tiles with one remap call each
+#
+def benchmark_warp(path, sizes=(1, 2, 4, 8)):
+    cf, level = open_chart(path)
+    size = (chart_tiler.tile_size, chart_tiler.tile_size)
+    blocks = [(block, cf.load_block(block)) for block in cf.tile_groups(cf.tile_list(level), chart_tiler.tile_block)]
+    ntiles = sum(len(block) for block, _ in blocks)
+
+    tm = time.time()
+    reference = {(tx, ty): cf.extract_tile(rect, size, win=win) for block, win in blocks for tx, ty, rect, _ in block}
+    base = time.time() - tm
+    print(f"{cf}: {ntiles} tiles at zoom {cf.zoom}, per tile {ntiles/max(base, 1e-6):.0f} tiles/s")
+
+    for n in sizes:
+        tm = time.time()
+        tiles = {}
+        for block, win in blocks:
+            for group in cf.tile_groups(block, n):
+                tiles.update(cf.remap_tiles(level, group, win)[0])
+        seconds = time.time() - tm
+        error = max(numpy.abs(tiles[xy].astype('int16') - reference[xy]).max() for xy in reference)
+        print(f"    {n}x{n} tiles ({n*chart_tiler.tile_size}x{n*chart_tiler.tile_size}): {ntiles/max(seconds, 1e-6):.0f} tiles/s, speedup {base/max(seconds, 1e-6):.2f}x, max error {error}")
+
+#
+# The homography error of the tiles of a chart at each zoom level, and the cost
+# and the effect of warping the tiles over the budget on a projected grid
+#
+def benchmark_errors(path, min_zoom=4):
+    cf, _ = open_chart(path)
+    chart_tiler.windowed_charts = False
+    cf.load_rgba()
+    cf.mask()
+    size = (chart_tiler.tile_size, chart_tiler.tile_size)
+
+    for zoom in range(cf.zoom, min_zoom-1, -1):
+        level = chart_tiler.MapLevel(None, 'benchmark', zoom)
+        tiles = cf.tile_list(level)
+        print(f"{cf}: zoom {zoom}, {len(tiles)} tiles, {chart_tiler.warp_error_str([error for _, _, _, error in tiles])}")
+        dense = [t for t in tiles if t[3] > chart_tiler.warp_error_budget]
+        if len(dense) == 0:
+            continue
+        tm = time.time()
+        fast = [cf.extract_tile(rect, size) for _, _, rect, _ in dense]
+        t1 = time.time() - tm
+        tm = time.time()
+        exact = [cf.extract_tile(rect, size, grid=cf.projected_grid(level, tx, ty, cf.window)) for tx, ty, rect, _ in dense]
+        t2 = time.time() - tm
+        diff = numpy.mean([numpy.abs(a[...,:3].astype('int16') - b[...,:3]).mean() for a, b in zip(fast, exact)])
+        print(f"    {len(dense)} tiles over {chart_tiler.warp_error_budget}px: homography {1000*t1/len(dense):.1f}ms/tile, projected {1000*t2/len(dense):.1f}ms/tile, mean rgb diff {diff:.2f}")
+
+#
+# The tiles of a chart at its native zoom with and without the footprint check,
+# the tiles that are skipped must come out transparent
+#
+def benchmark_footprint(path):
+    cf, level = open_chart(path)
+    size = (chart_tiler.tile_size, chart_tiler.tile_size)
+
+    tm = time.time()
+    shape = cf.footprint()
+    t1 = time.time() - tm
+    chart_tiler.footprint_tiles = False
+    tiles = cf.tile_list(level)
+    chart_tiler.footprint_tiles = True
+    inside = {(tx, ty) for tx, ty, _, _ in cf.tile_list(level)}
+    skipped = [t for t in tiles if (t[0], t[1]) not in inside]
+    print(f"{cf}: footprint in {t1:.3f}s, {100*shape.area/(cf.width*cf.height):.1f}% of the chart, {len(inside)} of {len(tiles)} tiles, {len(skipped)} skipped")
+
+    visible = 0
+    for block in cf.tile_groups(skipped, chart_tiler.tile_block):
+        win = cf.load_block(block)
+        visible += sum(1 for _, _, rect, _ in block if cf.extract_tile(rect, size, win=win)[...,3].any())
+    print(f"    {visible} skipped tiles with chart pixels")
+
+#
+# Tile one chart at its native zoom with an increasing number of threads
+#
+def benchmark_threads(path):
+    store = tile_store.open_store('benchmark', settings.tmp_dir, encode_threads=chart_tiler.encode_threads)
+    cf, level = open_chart(path, store)
+
+    base = None
+    nthreads = 1
+    while True:
+        store.clear()
+        chart_tiler.chart_threads = nthreads
+        touched = []
+        tm = time.time()
+        cf.save_tiles(chart_tiler.TileRouter(level, True, {}, None), 0, touched)
+        store.flush()
+        seconds = time.time() - tm
+        base = base or seconds
+        print(f"{cf}: {nthreads} threads, {len(touched)} tiles in {seconds:.1f}s, {len(touched)/max(seconds, 1e-6):.0f} tiles/s, speedup {base/max(seconds, 1e-6):.1f}x")
+        if nthreads >= os.cpu_count():
+            break
+        nthreads = min(2*nthreads, os.cpu_count())
+    store.close()
+    store.clear()
+
+#
+# Composite and downsample the tiles of a layer with the float kernels that were
+# used before, and with the fixed point kernels. The error of compositing is
+# measured against an exact float 'over', of downsampling against the float kernel.
+#
+def float_combine(tile1, tile2):
+    alpha1 = tile1[:,:,3] / 255
+    alpha2 = 1.0 - alpha1
+    for c in range(0, 3):
+        tile1[:,:,c] = tile1[:,:,c] * alpha1 + tile2[:,:,c] * alpha2
+    tile1[:,:,3] = numpy.maximum(tile1[:,:,3], tile2[:,:,3])
+    tile1[tile1[:,:,3] == 0] = 0
+    return tile1
+
+def premultiplied(tile):
+    tile = tile.astype('float32')
+    return numpy.concatenate((tile[...,:3] * tile[...,3:] / 255, tile[...,3:]), axis=-1)
+
+def float_over(src, dst):
+    a1, a2 = src[...,3:] / 255, dst[...,3:] / 255
+    alpha = a1 + a2 * (1 - a1)
+    rgb = numpy.divide(src[...,:3] * a1 + dst[...,:3] * a2 * (1 - a1), alpha, out=numpy.zeros(src[...,:3].shape), where=alpha > 0)
+    return numpy.concatenate((rgb, alpha * 255), axis=-1)
+
+def float_downsample(tmp):
+    tmp = tmp.astype('float32')
+    tmp[...,:3] *= tmp[...,3:] / 255
+    tile = (tmp[0::2,0::2] + tmp[0::2,1::2] + tmp[1::2,0::2] + tmp[1::2,1::2]) * 0.25
+    alpha = tile[...,3:]
+    out = numpy.empty(tile.shape, dtype='uint8')
+    out[...,:3] = numpy.clip(numpy.divide(tile[...,:3] * 255, alpha, out=numpy.zeros_like(tile[...,:3]), where=alpha > 0) + 0.5, 0, 255)
+    out[...,3] = numpy.clip(alpha[...,0] + 0.5, 0, 255)
+    return out
+
+def benchmark_composite(src_path, zoom, max_tiles=500):
+    store = tile_store.DirectoryTileStore(src_path)
+    tiles = [store.read_tile(zoom, x, y) for x, y in sorted(store.tiles(zoom))[:max_tiles]]
+    edges = [tile for tile in tiles if tile[...,3].min() < 255]
+    print(f"{store}: {len(tiles)} tiles at zoom {zoom}, {len(edges)} not opaque")
+
+    for name, srcs in (('all', tiles), ('edges', edges)):
+        pairs = list(zip(srcs, tiles[1:] + tiles[:1]))
+        for kernel, combine in (('float', float_combine), ('fixed', chart_tiler.composite_tiles)):
+            copies = [(src.copy(), dst) for src, dst in pairs]
+            tm = time.time()
+            results = [combine(src, dst) for src, dst in copies]
+            seconds = time.time() - tm
+            error = max([numpy.abs(premultiplied(result) - premultiplied(float_over(src, dst))).max() for result, (src, dst) in zip(results, pairs)] + [0])
+            print(f"    composite {name} {kernel}: {1000*seconds/max(len(pairs), 1):.3f}ms/tile, {len(pairs)/max(seconds, 1e-6):.0f} tiles/s, max error {error:.1f}")
+
+    s = chart_tiler.tile_size
+    quads = []
+    for i in range(0, len(tiles) - 3, 4):
+        tmp = numpy.zeros((2*s, 2*s, 4), dtype='uint8')
+        for j, (offx, offy) in enumerate(((0, 0), (1, 0), (0, 1), (1, 1))):
+            tmp[s*offy:s*offy+s, s*offx:s*offx+s] = tiles[i+j]
+        quads.append(tmp)
+    for kernel in ('float', 'fixed'):
+        tm = time.time()
+        if kernel == 'float':
+            results = [float_downsample(tmp) for tmp in quads]
+        else:
+            results = [chart_tiler.unpremultiply(chart_tiler.downsample(chart_tiler.premultiply(tmp))) for tmp in quads]
+        seconds = time.time() - tm
+        if kernel == 'float':
+            reference = results
+        error = max([numpy.abs(premultiplied(result) - premultiplied(ref)).max() for result, ref in zip(results, reference)] + [0])
+        print(f"    downsample {kernel}: {1000*seconds/max(len(quads), 1):.3f}ms/tile, {len(quads)/max(seconds, 1e-6):.0f} tiles/s, max diff {error}")
+
+#
+# Remove the last chart from a layer of the charts with an incremental update,
+# and compare the tiles and the coverage with a fresh build of the other charts
+#
+def build_layer(path, charts, incremental):
+    store = tile_store.DirectoryTileStore(path)
+    provenance = chart_tiler.load_provenance(store, chart_tiler.max_zoom) if incremental else None
+    if provenance is None:
+        store.clear()
+    levels = chart_tiler.make_levels(store, 'benchmark', chart_tiler.max_zoom)
+    levels[0].load()
+    pool = chart_tiler.TilePool({'benchmark': store})
+    pool.run([chart_tiler.LayerJob(levels, charts, provenance=provenance)])
+    pool.close()
+    return store
+
+def benchmark_incremental(paths):
+    chart_tiler.ctx = multiprocessing.get_context('spawn')
+    updated = os.path.join(settings.tmp_dir, "benchmark.incremental")
+    fresh = os.path.join(settings.tmp_dir, "benchmark.fresh")
+    build_layer(updated, [open_chart(path)[0] for path in paths], False)
+    tm = time.time()
+    build_layer(updated, [open_chart(path)[0] for path in paths[:-1]], True)
+    print(f"removed {os.path.basename(paths[-1])} in {util.time_str(tm)}")
+    build_layer(fresh, [open_chart(path)[0] for path in paths[:-1]], False)
+
+    coverage = [chart_tiler.TileCoverage(chart_tiler.max_zoom) for _ in range(2)]
+    for cov, path in zip(coverage, (updated, fresh)):
+        cov.load(tile_store.DirectoryTileStore(path).coverage_path())
+    for zoom in range(chart_tiler.max_zoom+1):
+        tiles = [sorted(tile_store.DirectoryTileStore(path).tiles(zoom)) for path in (updated, fresh)]
+        same = numpy.array_equal(coverage[0].codes[zoom], coverage[1].codes[zoom]) and tiles[0] == tiles[1]
+        print(f"    zoom {zoom}: {len(tiles[0])} tiles, {coverage[0].count(zoom)} covered, fresh {len(tiles[1])} tiles, {coverage[1].count(zoom)} covered{'' if same else ', DIFFERENT'}")
+
+#
+# Run chart_tiler.py --plan and check that the tiles, the builds and the caches
+# of the charts are left as they were
+#
+def snapshot(paths):
+    files = {}
+    for path in paths:
+        if os.path.lexists(path):
+            files[path] = (os.lstat(path).st_mtime_ns, os.lstat(path).st_size)
+        for dir, dirs, names in os.walk(path):
+            for name in dirs + names:
+                st = os.lstat(os.path.join(dir, name))
+                files[os.path.join(dir, name)] = (st.st_mtime_ns, st.st_size)
+    return files
+
+def benchmark_plan():
+    paths = [settings.tiles_dir, settings.tile_builds_dir, settings.chart_cache_dir, settings.chart_diffs_dir, settings.chart_georef_file, settings.chart_memory_file, settings.chart_throughput_file]
+    before = snapshot(paths)
+    tm = time.time()
+    subprocess.run([sys.executable, os.path.join(os.path.dirname(__file__), "chart_tiler.py"), "--plan"], check=True)
+    seconds = time.time() - tm
+    after = snapshot(paths)
+    changed = sorted(path for path in before.keys() | after.keys() if before.get(path) != after.get(path))
+    print(f"plan in {seconds:.1f}s, {len(before):,} files, {len(changed)} changed")
+    for path in changed[:20]:
+        print(f"    {'added' if path not in before else 'removed' if path not in after else 'changed'} {path}")
+
+#
+# Checks of the parts of the tiler, a check that fails raises an AssertionError
+#
+def check_morton():
+    assert [int(util.morton_code(x, y)) for x, y in ((0, 0), (1, 0), (0, 1), (3, 3), (4, 0))] == [0, 1, 2, 15, 16]
+    rng = numpy.random.default_rng(1)
+    tx, ty = rng.integers(0, 1 << 30, 1000), rng.integers(0, 1 << 30, 1000)
+    codes = util.morton_code(tx, ty)
+    x, y = util.morton_decode(codes)
+    assert numpy.array_equal(x, tx) and numpy.array_equal(y, ty)
+    assert numpy.array_equal(codes >> numpy.uint64(2), util.morton_code(tx >> 1, ty >> 1))
+    print("morton codes: ok")
+
+def check_coverage():
+    coverage = chart_tiler.TileCoverage(3)
+    coverage.touch(3, 5, 6)
+    coverage.touch(3, 5, 7)
+    assert [coverage.count(zoom) for zoom in range(4)] == [1, 1, 1, 2]
+    assert sorted(map(tuple, coverage.tiles(3).tolist())) == [(5, 6), (5, 7)]
+    assert coverage.tiles(2).tolist() == [[2, 3]]
+    coverage.discard(3, [(5, 6)])
+    coverage.discard(2, [(2, 3)])
+    assert [coverage.count(zoom) for zoom in range(4)] == [1, 1, 0, 1]
+    coverage.restore()
+    assert coverage.tiles(2).tolist() == [[2, 3]]
+    path = os.path.join(settings.tmp_dir, "check.coverage.npz")
+    coverage.save(path)
+    loaded = chart_tiler.TileCoverage(3)
+    assert loaded.load(path) and all(numpy.array_equal(a, b) for a, b in zip(loaded.codes, coverage.codes))
+    os.remove(path)
+    print("tile coverage: ok")
+
+def check_composite():
+    s = chart_tiler.tile_size
+    opaque = numpy.full((s, s, 4), (10, 20, 30, 255), dtype='uint8')
+    clear = numpy.full((s, s, 4), (40, 50, 60, 0), dtype='uint8')
+    half = numpy.full((s, s, 4), (255, 0, 0, 128), dtype='uint8')
+    assert numpy.array_equal(chart_tiler.composite_tiles(opaque.copy(), clear), opaque)
+    assert numpy.array_equal(chart_tiler.composite_tiles(clear.copy(), opaque), opaque)
+    assert not chart_tiler.composite_tiles(clear.copy(), None).any()
+    src = numpy.concatenate((half[:s//2], opaque[s//2:]))
+    out = chart_tiler.composite_tiles(src.copy(), opaque)
+    assert numpy.abs(premultiplied(out) - premultiplied(float_over(src, opaque))).max() <= 1
+    assert numpy.array_equal(out[s//2:], opaque[s//2:])
+    print("composite tiles: ok")
+
+def check_encode():
+    s = chart_tiler.tile_size
+    rng = numpy.random.default_rng(1)
+    tile = numpy.full((s, s, 4), 255, dtype='uint8')
+    tile[...,:3] = cv2.GaussianBlur(rng.integers(0, 256, (s, s, 3), dtype='uint8'), (9, 9), 0)
+    edge = tile.copy()
+    edge[:s//4,:,3] = 0
+    for format in tile_store.formats:
+        for src in (tile, edge):
+            encoded, data, _ = tile_store.encode_tile(src, format)
+            decoded = tile_store.decode_tile(data)
+            assert encoded == (tile_store.alpha_formats.get(format, format) if src is edge else format)
+            assert numpy.array_equal(decoded[...,3], src[...,3])
+            error = numpy.abs(decoded[...,:3].astype('int16') - src[...,:3])[src[...,3] > 0].mean()
+            assert error == 0 if encoded in ('png', 'webp') else error < 8, (format, error)
+    palette = rng.integers(0, 256, (256, 3), dtype='uint8')
+    index = rng.integers(0, 256, (s, s), dtype='uint8')
+    encoded, data, _ = tile_store.encode_tile(index, 'png', palette)
+    assert encoded == 'indexed' and numpy.array_equal(tile_store.decode_tile(data)[...,:3], palette[index])
+    print("encode tiles: ok")
+
+def check_tile_rects(path):
+    cf, level = open_chart(path)
+    tx, ty, rects = cf.tile_rects(level)
+    assert len(rects) > 0 and rects.shape == (len(tx), 4, 2)
+    for i in numpy.linspace(0, len(rects)-1, min(100, len(rects))).astype(int):
+        for corner, (dx, dy) in enumerate(((0, 0), (1, 0), (1, 1), (0, 1))):
+            xy = cf.lonlat2xy(level.xy2lonlat(((tx[i] + dx) * chart_tiler.tile_size, (ty[i] + dy) * chart_tiler.tile_size)))
+            assert numpy.abs(numpy.array(xy) - rects[i][corner]).max() < 0.01, (tx[i], ty[i], corner)
+    assert (numpy.maximum(rects[:,1,0], rects[:,2,0]) > 0).all() and (numpy.minimum(rects[:,0,0], rects[:,3,0]) < cf.width).all()
+    assert (numpy.minimum(rects[:,2,1], rects[:,3,1]) > 0).all() and (numpy.maximum(rects[:,0,1], rects[:,1,1]) < cf.height).all()
+    chart_tiler.footprint_tiles = False
+    all_tiles = set(zip(*cf.tile_rects(level)[:2]))
+    chart_tiler.footprint_tiles = True
+    assert set(zip(tx, ty)) <= all_tiles
+    print(f"{cf}: tile rects of {len(rects)} tiles at zoom {cf.zoom}: ok")
+
+def checks(paths):
+    check_morton()
+    check_coverage()
+    check_composite()
+    check_encode()
+    for path in paths:
+        check_tile_rects(path)
+
+if __name__ == '__main__':
+    tm = time.time()
+    if len(sys.argv) < 2:
+        print("usage: chart_benchmark.py notes <chart.tif> ... | store <tiles dir> <zoom> | encode <tiles dir> <zoom> | palette <chart.tif> ... | pyramid <tiles dir> <zoom> | coverage <tiles dir> | warp <chart.tif> ... | errors <chart.tif> ... | footprint <chart.tif> ... | threads <chart.tif> ... | composite <tiles dir> <zoom> | plan | incremental <chart.tif> ... | checks [<chart.tif> ...]")
+        sys.exit(1)
+
+    if sys.argv[1] == 'notes':
+        for path in sys.argv[2:]:
+            benchmark_notes(path)
+    elif sys.argv[1] == 'store':
+        benchmark_store(sys.argv[2], int(sys.argv[3]))
+    elif sys.argv[1] == 'encode':
+        benchmark_encode(sys.argv[2], int(sys.argv[3]))
+    elif sys.argv[1] == 'palette':
+        for path in sys.argv[2:]:
+            benchmark_palette(path)
+    elif sys.argv[1] == 'pyramid':
+        benchmark_pyramid(sys.argv[2], int(sys.argv[3]))
+    elif sys.argv[1] == 'coverage':
+        benchmark_coverage(sys.argv[2])
+    elif sys.argv[1] == 'warp':
+        for path in sys.argv[2:]:
+            benchmark_warp(path)
+    elif sys.argv[1] == 'errors':
+        for path in sys.argv[2:]:
+            benchmark_errors(path)
+    elif sys.argv[1] == 'footprint':
+        for path in sys.argv[2:]:
+            benchmark_footprint(path)
+    elif sys.argv[1] == 'threads':
+        for path in sys.argv[2:]:
+            benchmark_threads(path)
+    elif sys.argv[1] == 'composite':
+        benchmark_composite(sys.argv[2], int(sys.argv[3]))
+    elif sys.argv[1] == 'plan':
+        benchmark_plan()
+    elif sys.argv[1] == 'incremental':
+        benchmark_incremental(sys.argv[2:])
+    elif sys.argv[1] == 'checks':
+        checks(sys.argv[2:])
+
+    print(f"done in {util.time_str(tm)}")
@@ -1,45 +1,105 @@
 # (c)2018-2020, Artfahrt Inc, Arthur van Hoff
 
-import os, zipfile, time, multiprocessing
-import settings, util
+import os, shutil, zipfile, time, multiprocessing, osgeo.gdal
+import settings, util, chart_tiler
 
 max_download_workers = 8
+max_convert_workers = 4
+cog_charts = True
+zip_charts = False
+cog_options = ['COMPRESS=DEFLATE', 'BLOCKSIZE=512', 'OVERVIEWS=NONE', 'BIGTIFF=IF_SAFER']
 
-def download_chart(q):
+# the chart lists that the tiler reads
+tiled_lists = {table for _, _, table, _ in chart_tiler.layer_jobs}
+
+# the charts as they were downloaded, the converted charts are in a cog directory below
+def chart_source(chart):
+    path = chart['path']
+    return os.path.dirname(path) if os.path.basename(path) == "cog" else path
+
+# with zip_charts the zip is kept in the directory of the chart, with an index of its
+# members, instead of extracting it. The point of zip_charts is to keep a single copy
+# of each chart, so the charts are not converted to COGs then.
+def download_chart(q, cq, list_name, convert):
     while True:
         task = q.get()
         if task[0] == 'done':
             break
 
         chart = task[1]
-        path = chart['path']
-        if os.path.exists(path):
-            continue
-
-        zip_path = util.download_file(chart['href'])
-        if zip_path is None:
-            continue
-
-        try:
-            with zipfile.ZipFile(zip_path) as zip:
-                zip.extractall(settings.tmp_dir)
-                print("installing", chart['name'])
+        path = chart_source(chart)
+        if not os.path.exists(os.path.join(path, util.chart_index) if zip_charts else path):
+            if zip_charts:
                 os.makedirs(path, exist_ok=True)
-                for name in zip.namelist():
-                    os.rename(os.path.join(settings.tmp_dir, name), os.path.join(path, name))
-        except zipfile.BadZipFile:
-            print("%s: bad zipfile" % (zip_path))
-        finally:
-            #os.remove(zip_path)
-            pass
-
-def download_charts(list_name, max_workers=max_download_workers):
+            zip_path = util.download_file(chart['href'], os.path.join(path, os.path.basename(chart['href'])) if zip_charts else None)
+            if zip_path is None:
+                continue
+
+            try:
+                with zipfile.ZipFile(zip_path) as zip:
+                    print("installing", chart['name'])
+                    if zip_charts:
+                        util.save_chart_index(path, zip_path, zip)
+                    else:
+                        zip.extractall(settings.tmp_dir)
+                        os.makedirs(path, exist_ok=True)
+                        for name in zip.namelist():
+                            shutil.move(os.path.join(settings.tmp_dir, name), os.path.join(path, name))
+            except zipfile.BadZipFile:
+                print("%s: bad zipfile" % (zip_path))
+                continue
+            finally:
+                #os.remove(zip_path)
+                pass
+
+        if convert:
+            cq.put(('chart', list_name, chart))
+
+#
+# Convert the charts of the tiled lists to Cloud Optimized GeoTIFFs, tiled in blocks
+# and compressed, so that a window of a chart is read without decoding full strips.
+# The tiler only reads windows at full resolution, so there are no overviews. The
+# converted charts are kept below the charts as they were downloaded, and the path
+# of the chart is changed to them once they are all converted.
+#
+def convert_tif(src, dst):
+    if os.path.exists(dst) and os.path.getmtime(dst) >= osgeo.gdal.VSIStatL(src).mtime:
+        return True
+    tm = time.time()
+    if osgeo.gdal.Translate(dst + ".partial", src, format='COG', creationOptions=cog_options) is None:
+        print("%s: conversion failed" % (src))
+        return False
+    os.replace(dst + ".partial", dst)
+    print(f"converted {os.path.basename(src)}, {os.path.getsize(src)//(1024*1024)}MB => {os.path.getsize(dst)//(1024*1024)}MB, in {util.time_str(tm)}")
+    return True
+
+def convert_chart(q):
+    while True:
+        task = q.get()
+        if task[0] == 'done':
+            break
+
+        _, list_name, chart = task
+        source = chart_source(chart)
+        path = os.path.join(source, "cog")
+        os.makedirs(path, exist_ok=True)
+        srcs = util.chart_files(source)
+        if len(srcs) > 0 and all([convert_tif(src, os.path.join(path, os.path.basename(src))) for src in srcs]) and chart['path'] != path:
+            chart['path'] = path
+            settings.db.hash_table(list_name).set(chart['name'], chart)
+
+# the charts are converted by their own workers, while the next charts are downloaded
+def download_charts(list_name, max_workers=max_download_workers, max_converters=max_convert_workers):
     chart_list = settings.db.hash_table(list_name)
+    convert = cog_charts and not zip_charts and list_name in tiled_lists
     max_workers = min(chart_list.count(), max_workers)
+    max_converters = min(chart_list.count(), max_converters) if convert else 0
 
     q = ctx.Queue(max_workers*2)
-    workers = [ctx.Process(target=download_chart, args=(q,)) for _ in range(max_workers)]
-    for w in workers:
+    cq = ctx.Queue()
+    workers = [ctx.Process(target=download_chart, args=(q, cq, list_name, convert)) for _ in range(max_workers)]
+    converters = [ctx.Process(target=convert_chart, args=(cq,)) for _ in range(max_converters)]
+    for w in workers + converters:
         w.start()
     for chart in chart_list.all():
         q.put(('chart', chart))
@@ -47,6 +107,10 @@ def download_charts(list_name, max_workers=max_download_workers):
         q.put(('done', ))
     for w in workers:
         w.join()
+    for _ in range(max_converters):
+        cq.put(('done', ))
+    for w in converters:
+        w.join()
 
 
 #
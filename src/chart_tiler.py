@@ -1,15 +1,40 @@
 # (c)2018, Arthur van Hoff
 
-import os, sys, glob, osgeo.gdal, osgeo.osr, pyproj, db, PIL.Image, math, numpy, re, affine
-import cv2, shutil, tqdm, multiprocessing, filelock, hashlib, time, traceback
-import settings, util
+import os, sys, glob, osgeo.gdal, osgeo.osr, pyproj, db, PIL.Image, math, numpy, re, affine, shapely
+import cv2, tqdm, multiprocessing, time, traceback, functools, zlib, heapq, threading, queue, collections, concurrent.futures, hashlib, json
+import settings, util, tile_store
 
 max_zoom = 13
 tile_size = 256
 max_chart_workers = 16
-max_scale_workers = 32
+max_composite_workers = 8
+composite_batch = 64
+composite_interval = 1.0
+max_georef_workers = 8
+chart_threads = 4
+tile_store_type = 'dir'
+mbtiles_url = None
+layer_formats = {'sec': 'png', 'tac': 'png', 'fly': 'png', 'ifr_low': 'png', 'ifr_high': 'png'}
+encode_threads = 4
 save_chart_images = False
 save_chart_tiles = True
+windowed_charts = True
+vectorized_notes = True
+palette_tiles = False
+chart_cache = True
+footprint_tiles = True
+incremental_tiles = True
+diff_block = 256
+chart_cache_budget = 32*1024*1024*1024
+chart_memory_budget = 24*1024*1024*1024
+chart_bytes_per_pixel = 12
+pyramid_depth = 3
+tile_block = 8
+warp_tiles = 0
+warp_grid_step = 16
+warp_error_budget = 0.5
+warp_error_bins = [0, 0.1, 0.25, 0.5, 1, 2, 4]
+warp_margin = 2
 areas = None
 #areas = {"San Francisco", "Seattle", "Los Angeles", "Las Vegas", "Phoenix", "Klamath Falls", "Salt Lake City", "Great Falls"}
 #areas = {"Caribbean - 1", "Caribbean - 2"}
@@ -18,11 +43,93 @@ areas = None
 epsg3857 = pyproj.Proj('epsg:3857')
 earth_circumference = epsg3857(180, 0)[0] - epsg3857(-180, 0)[0]
 
+#
+# Projections between two coordinate systems, shared by all charts in a worker
+#
+@functools.lru_cache(maxsize=None)
+def transformer(src, dst):
+    return pyproj.Transformer.from_crs(pyproj.CRS(src), pyproj.CRS(dst), always_xy=True)
+
+#
+# TileCoverage - the tiles of a layer that have content, per zoom level, as
+# sorted arrays of Morton codes. Touched tiles are collected and merged in
+# batches, the parent of a code is code >> 2 so the new tiles propagate up
+# one level at a time and stop at tiles that were already covered.
+# The index is saved next to the tiles of the layer.
+#
+class TileCoverage:
+    def __init__(self, max_zoom):
+        self.codes = [numpy.zeros(0, dtype='uint64') for _ in range(max_zoom+1)]
+        self.pending = [[] for _ in range(max_zoom+1)]
+        self.loaded = False
+
+    # the coverage stays in the main process
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['codes'] = [numpy.zeros(0, dtype='uint64') for _ in self.codes]
+        state['pending'] = [[] for _ in self.pending]
+        return state
+
+    def touch(self, zoom, tx, ty):
+        self.pending[zoom].append(int(util.morton_code(tx, ty)))
+
+    def merge(self):
+        added = numpy.zeros(0, dtype='uint64')
+        for zoom in range(len(self.codes)-1, -1, -1):
+            if len(self.pending[zoom]) == 0 and len(added) == 0:
+                continue
+            codes = numpy.concatenate((numpy.array(self.pending[zoom], dtype='uint64'), added >> numpy.uint64(2)))
+            added = numpy.setdiff1d(codes, self.codes[zoom])
+            self.codes[zoom] = numpy.union1d(self.codes[zoom], added)
+            self.pending[zoom] = []
+
+    def count(self, zoom):
+        self.merge()
+        return len(self.codes[zoom])
+
+    # remove tiles of a zoom level, their parents stay covered
+    def discard(self, zoom, tiles):
+        self.merge()
+        if len(tiles) > 0:
+            tx, ty = numpy.array(list(tiles), dtype='int64').T
+            self.codes[zoom] = numpy.setdiff1d(self.codes[zoom], util.morton_code(tx, ty))
+
+    # cover the parents of the covered tiles again, after tiles were discarded
+    def restore(self):
+        self.merge()
+        for zoom in range(len(self.codes)-1, 0, -1):
+            self.codes[zoom-1] = numpy.union1d(self.codes[zoom-1], self.codes[zoom] >> numpy.uint64(2))
+
+    # the covered tiles of a zoom level in Z-order, shape (n, 2)
+    def tiles(self, zoom):
+        self.merge()
+        tx, ty = util.morton_decode(self.codes[zoom])
+        return numpy.stack((tx, ty), axis=-1)
+
+    def save(self, path):
+        self.merge()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp = path + ".new.npz"
+        numpy.savez(tmp, **{f"zoom{zoom}": codes for zoom, codes in enumerate(self.codes)})
+        os.replace(tmp, path)
+
+    def load(self, path):
+        self.loaded = True
+        if not os.path.exists(path):
+            return False
+        with numpy.load(path) as data:
+            for zoom in range(len(self.codes)):
+                if f"zoom{zoom}" in data:
+                    self.codes[zoom] = numpy.union1d(self.codes[zoom], data[f"zoom{zoom}"])
+        return True
+
 #
 # MapLevel - represents one scale level tiles
 #
 class MapLevel:
-    def __init__(self, base, type, zoom, proj=epsg3857):
+    def __init__(self, store, type, zoom, proj=epsg3857, coverage=None):
+        self.store = store
+        self.coverage = coverage or TileCoverage(zoom)
         self.type = type
         self.zoom = zoom
         self.proj = proj
@@ -31,14 +138,10 @@ class MapLevel:
         self.zoom_out = None
         self.zoom_in = None
 
-        self.dir = os.path.join(os.path.join(base, type), f"{self.zoom}")
-        os.makedirs(self.dir, exist_ok=True)
-
         self.meters_per_pixel = earth_circumference / self.map_size
         self.reverse_transform = affine.Affine.scale(self.map_size/earth_circumference, -self.map_size/earth_circumference)
         self.reverse_transform = affine.Affine.translation(self.map_size/2, self.map_size/2) * self.reverse_transform
         self.forward_transform = ~self.reverse_transform
-        self.touched = numpy.zeros((self.tile_count, self.tile_count), dtype='bool')
 
     # map lonlat to xy in pixels
     def lonlat2xy(self, lonlat):
@@ -49,77 +152,342 @@ class MapLevel:
         x, y = self.forward_transform * (xy[0], xy[1])
         return self.proj(x, y, inverse=True)
 
+    # mark a tile and its parents as covered
     def touch(self, txy):
-        self.touched[txy[0], txy[1]] = True
-        if self.zoom_out is not None:
-            self.zoom_out.touch((txy[0]//2, txy[1]//2))
+        self.coverage.touch(self.zoom, txy[0], txy[1])
 
+    def tiles(self):
+        return self.coverage.tiles(self.zoom)
+
+    # restore the coverage of the layer from the saved index, or from the tiles in the store
     def load(self):
-        for x in tqdm.tqdm(os.listdir(self.dir)):
-            tx = int(x)
-            for y in os.listdir(os.path.join(self.dir, x)):
-                if y[0] != '.':
-                    ty = int(y[:-4])
-                    self.touch((tx, ty))
+        if not self.coverage.loaded:
+            tm = time.time()
+            if not self.coverage.load(self.store.coverage_path()):
+                for zoom in range(len(self.coverage.codes)):
+                    for tx, ty in tqdm.tqdm(self.store.tiles(zoom)):
+                        self.coverage.touch(zoom, tx, ty)
+                self.save()
+            print(f"loaded coverage of {self.store} in {util.time_str(tm)}")
+
+    def save(self):
+        self.coverage.save(self.store.coverage_path())
 
     def __str__(self):
-        used = self.touched.sum()
+        used = self.coverage.count(self.zoom)
         total = self.tile_count*self.tile_count
         kb = 50
         return f"MapLevel(zoom={self.zoom}, width={self.map_size}, tiles={self.tile_count}x{self.tile_count}, used={used}/{total}, {100*used/total:.2f}%, {used*kb/(1024*1024):.1f}GB, m/pix={self.meters_per_pixel})"
 
-def make_levels(base, type, max_zoom):
-    levels = [MapLevel(base, type, zoom) for zoom in range(0, max_zoom+1)]
+def make_levels(store, type, max_zoom):
+    coverage = TileCoverage(max_zoom)
+    levels = [MapLevel(store, type, zoom, coverage=coverage) for zoom in range(0, max_zoom+1)]
     for zoom in range(0, len(levels)-1):
         levels[zoom].zoom_in = levels[zoom+1]
         levels[zoom+1].zoom_out = levels[zoom]
     return levels
 
-def combine_tiles(tile1, tile2):
-    if tile2 is not None:
-        assert tile1 is not None
-        alpha1 = tile1[:,:,3] / 255
-        alpha2 = 1.0 - alpha1
-        for c in range(0, 3):
-            tile1[:,:,c] = tile1[:,:,c] * alpha1 + tile2[:,:,c] * alpha2
-        tile1[:,:,3] = numpy.maximum(tile1[:,:,3], tile2[:,:,3])
-
-def write_tile(path, tile):
+#
+# Compositing in premultiplied fixed point, shared by the charts and the pyramid.
+# Tiles are stored as straight rgba, premultiplied tiles are uint16 scaled by 255,
+# (r*a, g*a, b*a, a*255), so that the product of two uint8 values fits, and the
+# cv2 arithmetic rounds and saturates. The colors of transparent pixels are 0.
+#
+def premultiply(tile):
+    alpha = cv2.extractChannel(tile, 3)
+    return cv2.multiply(tile, cv2.merge((alpha, alpha, alpha, numpy.full_like(alpha, 255))), dtype=cv2.CV_16U)
+
+def unpremultiply(tile):
+    alpha = cv2.extractChannel(tile, 3)
+    return cv2.divide(tile, cv2.merge((alpha, alpha, alpha, numpy.full_like(alpha, 255*255))), scale=255, dtype=cv2.CV_8U)
+
+# the rounded mean of 2x2 pixels
+def downsample(tmp):
+    return cv2.resize(tmp, (tmp.shape[1]//2, tmp.shape[0]//2), interpolation=cv2.INTER_AREA)
+
+# src over dst, an opaque src does not need dst and a transparent src leaves it as it is
+def composite_tiles(src, dst):
+    alpha = cv2.extractChannel(src, 3)
+    low, high, _, _ = cv2.minMaxLoc(alpha)
+    if low == 255:
+        return src
+    if dst is None:
+        src[alpha == 0] = 0
+        return src
+    if high == 0:
+        return dst
+    # opaque pixels are copied, only the pixels that are partially transparent are blended
+    out = cv2.copyTo(src, alpha, dst.copy())
+    x, y, w, h = cv2.boundingRect(cv2.inRange(alpha, 1, 254))
+    if w > 0:
+        src, dst, alpha = src[y:y+h,x:x+w], dst[y:y+h,x:x+w], alpha[y:y+h,x:x+w]
+        inverse = (255 - alpha).astype('uint16')
+        below = cv2.multiply(premultiply(dst), cv2.merge((inverse, inverse, inverse, inverse)), scale=1/255)
+        out[y:y+h,x:x+w] = unpremultiply(cv2.add(premultiply(src), below))
+    return out
+
+def write_tile(store, zoom, tx, ty, tile):
     if tile[:,:,3].any():
         tile[tile[:,:,3] == 0] = 0
-        dir_name, file_name = os.path.split(path)
-        new_path = os.path.join(dir_name, ".new_" + file_name)
-        PIL.Image.fromarray(tile).save(new_path)
-        if os.path.exists(path):
-            os.remove(path)
-        os.rename(new_path, path)
+        store.write_tile(zoom, tx, ty, tile)
         return True
     return False
 
+# write a tile over the tile in the store, the existing tile is only read when it shows through
+def save_tile(level, tx, ty, tile, overwrite):
+    low, high, _, _ = cv2.minMaxLoc(cv2.extractChannel(tile, 3))
+    if high == 0:
+        return False
+    if low < 255:
+        tile = composite_tiles(tile, None if overwrite else level.store.read_tile(level.zoom, tx, ty))
+    level.store.write_tile(level.zoom, tx, ty, tile)
+    return True
+
+def quadkey(tx, ty, zoom):
+    key = ''
+    for i in range(zoom, 0, -1):
+        mask = 1 << (i - 1)
+        key += str((1 if tx & mask else 0) + (2 if ty & mask else 0))
+    return key
+
+#
+# TileRouter: decides who writes a tile of a zoom level. A tile covered by one
+# chart is written by the chart worker. A tile shared by several charts is owned
+# by one composite worker, picked by hashing its quadkey, which receives all the
+# contributions and composites them in chart order. Every tile is written once.
+# shared maps the shared tiles of a chart to the number of charts that cover them,
+# which is sent along so that the composite worker knows when a tile is complete.
+#
+class TileRouter:
+    def __init__(self, level, overwrite, shared, queues):
+        self.level = level
+        self.overwrite = overwrite
+        self.shared = shared
+        self.queues = queues
+        self.sent = set()
+
+    def owner(self, tx, ty):
+        return zlib.crc32(quadkey(tx, ty, self.level.zoom).encode('utf-8')) % len(self.queues)
+
+    def put(self, tx, ty, order, tile, touched):
+        if (tx, ty) in self.shared:
+            self.send(tx, ty, order, tile if tile[:,:,3].any() else None)
+        elif save_tile(self.level, tx, ty, tile, self.overwrite):
+            touched.append((tx, ty))
+
+    def send(self, tx, ty, order, tile):
+        self.sent.add((tx, ty))
+        self.queues[self.owner(tx, ty)].put(('tile', self.level.type, self.level.zoom, tx, ty, order, tile, self.shared[(tx, ty)], self.overwrite))
+
+    # send empty contributions for the shared tiles not sent, so that their composites complete
+    def finish(self, order):
+        for tx, ty in self.shared:
+            if (tx, ty) not in self.sent:
+                self.send(tx, ty, order, None)
+
+    # an opaque palette tile covered by one chart
+    def put_index(self, tx, ty, index, palette, touched):
+        self.level.store.write_tile(self.level.zoom, tx, ty, index, palette)
+        touched.append((tx, ty))
+
+    # composite the contributions to a tile, later charts on top
+    def composite(self, tx, ty, parts, touched):
+        tile = None
+        for _, part in sorted(parts, key=lambda part: part[0]):
+            if part is not None:
+                tile = composite_tiles(part, tile)
+        if tile is not None and save_tile(self.level, tx, ty, tile, self.overwrite):
+            touched.append((tx, ty))
+
+def ramp(d, n):
+    return numpy.clip(d / n, 0, 1).astype('float32')
+
+#
+# Fade alpha along a cut with one column per row, nan where a row is not cut.
+# With direction 1 the pixels right of the cut are kept, with -1 the pixels left
+# of it. The fade covers the m pixels next to the cut, everything beyond it is cleared.
+#
+def fade_cut(alpha, cut, e, m, direction):
+    rows = numpy.flatnonzero(~numpy.isnan(cut))
+    if len(rows) == 0:
+        return
+    r1, r2 = rows[0], rows[-1] + 1
+    width = alpha.shape[1]
+    valid = ~numpy.isnan(cut[r1:r2])
+    band = alpha[r1:r2]
+    cut = numpy.where(valid, cut[r1:r2], 0).astype('int64')
+
+    # clear the pixels on the other side of the cut
+    if direction > 0:
+        start = cut + e
+        x1, x2 = numpy.clip((start[valid].min(), start[valid].max()), 0, width)
+        band[valid, :x1] = 0
+        clear = numpy.arange(x1, x2)[None, :] < start[:, None]
+        steps = numpy.arange(0, m) / m
+    else:
+        start = cut - e - m
+        x1, x2 = numpy.clip((start[valid].min() + m, start[valid].max() + m), 0, width)
+        band[valid, x2:] = 0
+        clear = numpy.arange(x1, x2)[None, :] >= start[:, None] + m
+        steps = numpy.flip(numpy.arange(0, m) / m)
+    clear &= valid[:, None]
+    band[:, x1:x2][clear] = 0
+
+    # fade the m pixels next to the cut
+    cols = start[valid][:, None] + numpy.arange(0, m)[None, :]
+    inside = (cols >= 0) & (cols < width)
+    rows = numpy.broadcast_to(numpy.flatnonzero(valid)[:, None], cols.shape)[inside]
+    cols = cols[inside]
+    band[rows, cols] = band[rows, cols] * numpy.broadcast_to(steps[None, :], inside.shape)[inside]
+
+#
+# ChartWindow: the rgba pixels of a rectangle of a chart,
+# faded using absolute chart coordinates.
+#
+class ChartWindow:
+    def __init__(self, rgba, x, y, index=None, masked=False):
+        self.rgba = rgba
+        self.index = index
+        self.masked = masked
+        self.x = x
+        self.y = y
+        self.width = rgba.shape[1]
+        self.height = rgba.shape[0]
+
+    # multiply the alpha of the chart rectangle (x1,y1)-(x2,y2) by alpha,
+    # which is either a scalar or an array spanning the rectangle
+    def fade(self, x1, y1, x2, y2, alpha=0):
+        cx1, cy1 = max(x1, self.x), max(y1, self.y)
+        cx2, cy2 = min(x2, self.x + self.width), min(y2, self.y + self.height)
+        if cx1 >= cx2 or cy1 >= cy2:
+            return
+        dst = self.rgba[cy1-self.y:cy2-self.y, cx1-self.x:cx2-self.x, 3]
+        if isinstance(alpha, numpy.ndarray):
+            if alpha.shape[0] > 1:
+                alpha = alpha[cy1-y1:cy2-y1]
+            if alpha.shape[1] > 1:
+                alpha = alpha[:, cx1-x1:cx2-x1]
+            dst[...] = dst * alpha
+        elif alpha == 0:
+            dst[...] = 0
+        else:
+            dst[...] = dst * alpha
+
+    # points that fall in the rows of this window
+    def rows(self, points):
+        return points[(points[:,1] >= self.y) & (points[:,1] < self.y + self.height)]
+
+    # points that fall in the columns of this window
+    def cols(self, points):
+        return points[(points[:,0] >= self.x) & (points[:,0] < self.x + self.width)]
+
+#
+# Remap grids are computed on a lattice of step pixels and upsampled with cv2.resize,
+# which samples the source at (i + 0.5)/step - 0.5. The lattice points are placed
+# so that this lands on the pixels, with one extra point on each side for the edges.
+#
+def grid_lattice(step):
+    return (numpy.arange(tile_size // step + 2) - 1) * step + (step - 1) / 2
+
+def upsample_grid(lattice, step):
+    n = lattice.shape[0] * step
+    return cv2.resize(lattice.astype('float32'), (n, n), interpolation=cv2.INTER_LINEAR)[step:step+tile_size, step:step+tile_size]
+
+# a histogram of the warp errors of the tiles of a chart, in tile pixels
+def warp_error_str(errors):
+    counts, _ = numpy.histogram(errors, warp_error_bins + [numpy.inf])
+    bins = [f"<{b}px {c}" for b, c in zip(warp_error_bins[1:], counts)] + [f">={warp_error_bins[-1]}px {counts[-1]}"]
+    return f"warp error {', '.join(bins)}, max {numpy.max(errors):.2f}px"
+
+def warp_stats_str(stats):
+    result = []
+    for kind in ('warp', 'dense', 'remap'):
+        if f"{kind}_time" in stats:
+            result.append(f"{kind} {stats[f'{kind}_time']:.2f}s")
+    return ', '.join(result)
+
+#
+# Remove the least recently used decoded charts until the cache fits in budget bytes
+#
+def evict_chart_cache(budget, keep=None):
+    entries = {}
+    for path in glob.glob(os.path.join(settings.chart_cache_dir, "*.npy")):
+        if path.endswith(".blocks.npy"):
+            continue
+        key = path[:-len(".index.npy")]
+        size, used = entries.get(key, (0, 0))
+        entries[key] = (size + os.path.getsize(path), max(used, os.path.getmtime(path) if path.endswith(".alpha.npy") else 0))
+    total = sum(size for size, _ in entries.values())
+    for key, (size, _) in sorted(entries.items(), key=lambda entry: entry[1][1]):
+        if total <= budget:
+            break
+        if key != keep:
+            print(f"evicting {os.path.basename(key)}, {size/(1024*1024):.0f}MB")
+            for ext in (".alpha.npy", ".index.npy"):
+                if os.path.exists(key + ext):
+                    os.remove(key + ext)
+            total -= size
+
+#
+# Remove the block hashes of all but the newest versions of a chart, the hashes of the
+# edition before are kept to compare the next edition against
+#
+def prune_block_hashes(name, keep=2):
+    paths = glob.glob(os.path.join(settings.chart_cache_dir, f"{re.sub('[^A-Za-z0-9]+', '_', name)}-*.blocks.npy"))
+    for path in sorted(paths, key=os.path.getmtime, reverse=True)[keep:]:
+        if os.path.exists(path):
+            os.remove(path)
+
 #
 # ChartFile: encapsulates a single TIF file
 # Manage projection to/from lon/lat => x,y
 #
 class ChartFile:
-    def __init__(self, name:str, path:str):
+    def __init__(self, name:str, path:str, date=None, georef=None):
         self.name = name
         self.path = path
-        ds = osgeo.gdal.Open(self.path)
-        self.tx = ds.GetGeoTransform()
-        self.width = ds.RasterXSize
-        self.height = ds.RasterYSize
-
-        inSRS_wkt = ds.GetProjection()  # gives SRS in WKT
-        inSRS_converter = osgeo.osr.SpatialReference()  # makes an empty spatial ref object
-        inSRS_converter.ImportFromWkt(inSRS_wkt)  # populates the spatial ref object with our WKT SRS
-        self.proj = pyproj.Proj(inSRS_converter.ExportToProj4())  # Exports an SRS ref as a Proj4 string usable by PyProj
+        self.date = date
+        if georef is None:
+            ds = osgeo.gdal.Open(self.path)
+            self.tx = tuple(float(v) for v in ds.GetGeoTransform())
+            self.width = ds.RasterXSize
+            self.height = ds.RasterYSize
+
+            inSRS_wkt = ds.GetProjection()  # gives SRS in WKT
+            inSRS_converter = osgeo.osr.SpatialReference()  # makes an empty spatial ref object
+            inSRS_converter.ImportFromWkt(inSRS_wkt)  # populates the spatial ref object with our WKT SRS
+            self.proj4 = inSRS_converter.ExportToProj4()  # Exports an SRS ref as a Proj4 string usable by PyProj
+        else:
+            self.tx = tuple(georef['tx'])
+            self.width = georef['width']
+            self.height = georef['height']
+            self.proj4 = georef['proj4']
+        self.proj = pyproj.Proj(self.proj4)
 
-        transform = affine.Affine.from_gdal(*ds.GetGeoTransform())
+        transform = affine.Affine.from_gdal(*self.tx)
         self.forward_transform = affine.Affine(*transform[:6])
         self.reverse_transform = ~self.forward_transform
 
         self.edge = 5
         self.margin = 50 if ' TAC' in path else 10
+        self.notes = settings.chart_notes.get(name, [])
+        self.points = {}
+        self.cuts = None
+        self.shape = None
+        self.local = threading.local()
+        self.clut = None
+        self.window = None
+        self.rgba = None
+        self.cache = None
+        self.only = None
+        self.content = None
+
+        if georef is not None:
+            self.content = georef.get('content')
+            self.lon_min, self.lat_min, self.lon_max, self.lat_max = georef['bounds']
+            self.native_zoom = georef['zoom']
+            self.zoom = min(self.native_zoom, max_zoom)
+            return
 
         self.lon_min = 360
         self.lat_min = 180
@@ -140,30 +508,254 @@ class ChartFile:
 
         x1 = self.lonlat2xyr((self.lon_min, self.lat_min))[0]
         x2 = self.lonlat2xyr((self.lon_min+1, self.lat_min))[0]
-        self.zoom = min(math.ceil(math.log2(360*(x2-x1)/tile_size)), max_zoom)
+        self.native_zoom = math.ceil(math.log2(360*(x2-x1)/tile_size))
+        self.zoom = min(self.native_zoom, max_zoom)
+
+    # the georeference of the chart, for the georeference cache
+    def georef(self):
+        return {
+            'tx': self.tx,
+            'width': self.width,
+            'height': self.height,
+            'proj4': self.proj4,
+            'bounds': (self.lon_min, self.lat_min, self.lon_max, self.lat_max),
+            'zoom': self.native_zoom,
+            'content': self.content_hash(),
+        }
+
+    # the GDAL dataset and the raster are opened in the worker, not pickled
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['local'] = None
+        state['window'] = None
+        state['rgba'] = None
+        state['cache'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    # one GDAL dataset per thread, a dataset can not be shared by threads
+    def dataset(self):
+        if getattr(self.local, 'ds', None) is None:
+            self.local.ds = osgeo.gdal.Open(self.path)
+        return self.local.ds
+
+    def load_clut(self):
+        if self.clut is None:
+            rct = self.dataset().GetRasterBand(1).GetRasterColorTable()
+            clut = []
+            for i in range(rct.GetCount()):
+                entry = rct.GetColorEntry(i)
+                clut.append((entry[0], entry[1], entry[2], entry[3]))
+            self.clut = numpy.array(clut, dtype='uint8')
+        return self.clut
+
+    # read the chart rectangle (x1,y1)-(x2,y2) as rgba, pixels outside the chart are transparent,
+    # with palette_tiles the palette indices are kept as well. With chart_cache the window
+    # is read from the decoded chart, which is already masked.
+    def read_window(self, x1, y1, x2, y2):
+        clut = self.load_clut()
+        rgba = numpy.zeros((y2 - y1, x2 - x1, 4), dtype='uint8')
+        index = numpy.zeros((y2 - y1, x2 - x1), dtype='uint8') if palette_tiles else None
+        cx1, cy1 = max(x1, 0), max(y1, 0)
+        cx2, cy2 = min(x2, self.width), min(y2, self.height)
+        if cx1 < cx2 and cy1 < cy2:
+            if chart_cache:
+                data = self.cached()[0][cy1:cy2, cx1:cx2]
+            else:
+                data = self.dataset().GetRasterBand(1).ReadAsArray(cx1, cy1, cx2 - cx1, cy2 - cy1)
+            dst = rgba[cy1-y1:cy2-y1, cx1-x1:cx2-x1]
+            for i in range(3):
+                dst[...,i] = cv2.LUT(data, clut[:,i])
+            dst[...,3] = self.cached()[1][cy1:cy2, cx1:cx2] if chart_cache else cv2.LUT(data, clut[:,3])
+            if index is not None:
+                index[cy1-y1:cy2-y1, cx1-x1:cx2-x1] = data
+        return ChartWindow(rgba, x1, y1, index, chart_cache)
+
+    #
+    # The decoded chart cache: the palette indices and the masked alpha of a chart,
+    # as .npy files that the workers map in, so that the pages are shared and a
+    # chart is only decoded and masked again when it, or its notes, change.
+    #
+    def cache_path(self, version=None):
+        return os.path.join(settings.chart_cache_dir, f"{re.sub('[^A-Za-z0-9]+', '_', self.name)}-{version or self.version()}")
+
+    # the hash of the palette and the pixels of the chart, which stay the same when
+    # the file is converted or moved, read once and kept in the georeference cache
+    def content_hash(self, rows=1024):
+        if self.content is None:
+            h = hashlib.sha1(self.load_clut().tobytes())
+            for y in range(0, self.height, rows):
+                h.update(self.dataset().GetRasterBand(1).ReadAsArray(0, y, self.width, min(rows, self.height - y)).tobytes())
+            self.content = h.hexdigest()[:16]
+        return self.content
+
+    # the version of the chart, its date, its pixels and its notes
+    def version(self):
+        key = repr((self.name, self.date, self.content_hash(), self.notes, self.edge, self.margin, vectorized_notes))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+    # the layout of the chart, editions with the same layout cover the same tiles
+    def layout(self):
+        key = repr((self.width, self.height, self.tx, self.proj.srs, self.notes, self.edge, self.margin, vectorized_notes))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+    # the decoded chart is mapped before it is touched, another process may evict it
+    # at any time, the mapping stays valid after the files are removed
+    def cached(self):
+        if self.cache is None:
+            path = self.cache_path()
+            try:
+                self.cache = (numpy.load(path + ".index.npy", mmap_mode='r'), numpy.load(path + ".alpha.npy", mmap_mode='r'))
+            except FileNotFoundError:
+                self.build_cache(path)
+                self.cache = (numpy.load(path + ".index.npy", mmap_mode='r'), numpy.load(path + ".alpha.npy", mmap_mode='r'))
+            try:
+                os.utime(path + ".alpha.npy")
+            except FileNotFoundError:
+                pass
+        return self.cache
+
+    # decode and mask the chart in strips of rows, the alpha file is written last
+    def build_cache(self, path, rows=1024):
+        tm = time.time()
+        os.makedirs(settings.chart_cache_dir, exist_ok=True)
+        clut = self.load_clut()
+        index = numpy.lib.format.open_memmap(path + f".index.npy.{os.getpid()}", mode='w+', dtype='uint8', shape=(self.height, self.width))
+        alpha = numpy.lib.format.open_memmap(path + f".alpha.npy.{os.getpid()}", mode='w+', dtype='uint8', shape=(self.height, self.width))
+        for y in range(0, self.height, rows):
+            data = self.dataset().GetRasterBand(1).ReadAsArray(0, y, self.width, min(rows, self.height - y))
+            win = ChartWindow(numpy.stack([cv2.LUT(data, clut[:,i]) for i in range(4)], axis=-1), 0, y)
+            self.mask(win)
+            index[y:y+len(data)] = data
+            alpha[y:y+len(data)] = win.rgba[...,3]
+        index.flush()
+        alpha.flush()
+        del index, alpha
+        os.replace(path + f".index.npy.{os.getpid()}", path + ".index.npy")
+        os.replace(path + f".alpha.npy.{os.getpid()}", path + ".alpha.npy")
+        print(f"{self}: cached in {util.time_str(tm)}")
+        evict_chart_cache(chart_cache_budget, path)
+
+    #
+    # Chart diffs: the blocks of diff_block x diff_block pixels that changed since
+    # an earlier edition with the same layout, compared after palette expansion.
+    # The block hashes of an edition are kept with the chart cache, so the next
+    # edition is compared against the hashes. Without them the two editions are
+    # compared pixel by pixel. A report of the changed blocks is saved as json,
+    # it is reused by the other layers of the chart.
+    #
+    def strips(self):
+        clut = self.load_clut()
+        for y in range(0, self.height, diff_block):
+            yield clut[self.dataset().GetRasterBand(1).ReadAsArray(0, y, self.width, min(diff_block, self.height - y))]
+
+    def block_hash(self, block):
+        return int.from_bytes(hashlib.blake2b(numpy.ascontiguousarray(block).tobytes(), digest_size=8).digest(), 'little')
+
+    def save_block_hashes(self, hashes):
+        path = self.cache_path() + ".blocks.npy"
+        os.makedirs(settings.chart_cache_dir, exist_ok=True)
+        numpy.save(path + f".{os.getpid()}.npy", hashes)
+        os.replace(path + f".{os.getpid()}.npy", path)
+        prune_block_hashes(self.name)
+
+    def block_hashes(self):
+        path = self.cache_path() + ".blocks.npy"
+        if os.path.exists(path):
+            return numpy.load(path)
+        hashes = numpy.zeros((-(-self.height // diff_block), -(-self.width // diff_block)), dtype='uint64')
+        for by, strip in enumerate(self.strips()):
+            for bx in range(hashes.shape[1]):
+                hashes[by, bx] = self.block_hash(strip[:, bx*diff_block:(bx+1)*diff_block])
+        self.save_block_hashes(hashes)
+        return hashes
+
+    def compare_blocks(self, old):
+        hashes = numpy.zeros((-(-self.height // diff_block), -(-self.width // diff_block)), dtype='uint64')
+        changed = numpy.zeros(hashes.shape, dtype=bool)
+        for by, (strip, old_strip) in enumerate(zip(self.strips(), old.strips())):
+            for bx in range(hashes.shape[1]):
+                block = strip[:, bx*diff_block:(bx+1)*diff_block]
+                hashes[by, bx] = self.block_hash(block)
+                changed[by, bx] = not numpy.array_equal(block, old_strip[:, bx*diff_block:(bx+1)*diff_block])
+        self.save_block_hashes(hashes)
+        return changed
+
+    # the changed blocks since the edition of a provenance record, None if they can not be compared
+    def diff(self, record):
+        if diff_block == 0 or record.get('layout') != self.layout():
+            return None
+        path = os.path.join(settings.chart_diffs_dir, f"{re.sub('[^A-Za-z0-9]+', '_', self.name)}-{record['version']}-{self.version()}.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                report = json.load(f)
+            changed = numpy.zeros(report['shape'], dtype=bool)
+            for bx, by in report['blocks']:
+                changed[by, bx] = True
+            return changed
+
+        tm = time.time()
+        if os.path.exists(self.cache_path(record['version']) + ".blocks.npy"):
+            changed = self.block_hashes() != numpy.load(self.cache_path(record['version']) + ".blocks.npy")
+        elif record['path'] != self.path and os.path.exists(record['path']):
+            changed = self.compare_blocks(ChartFile(self.name, record['path'], record['date']))
+        else:
+            return None
+
+        by, bx = numpy.nonzero(changed)
+        corners = [self.xy2lonlat((x*diff_block, y*diff_block)) for x, y in zip(numpy.concatenate((bx, bx+1)).tolist(), numpy.concatenate((by, by+1)).tolist())]
+        report = {
+            'chart': self.name,
+            'old': {'path': record['path'], 'date': record['date'], 'version': record['version']},
+            'new': {'path': self.path, 'date': self.date, 'version': self.version()},
+            'block': diff_block,
+            'shape': list(changed.shape),
+            'changed': int(changed.sum()),
+            'blocks': [[x, y] for x, y in zip(bx.tolist(), by.tolist())],
+            'bounds': [min(lon for lon, _ in corners), min(lat for _, lat in corners), max(lon for lon, _ in corners), max(lat for _, lat in corners)] if len(corners) > 0 else None,
+        }
+        os.makedirs(settings.chart_diffs_dir, exist_ok=True)
+        with open(path + ".new", 'w') as f:
+            json.dump(report, f, indent=1)
+        os.replace(path + ".new", path)
+        print(f"{self}: {report['changed']} of {changed.size} blocks changed since {record['date'] or record['path']}, in {util.time_str(tm)}")
+        return changed
+
+    # read a window rounded out to GDAL blocks (not to full strips), with the edges faded and the notes applied
+    def load_window(self, x1, y1, x2, y2):
+        bw, bh = self.dataset().GetRasterBand(1).GetBlockSize()
+        if bw < self.width:
+            x1, x2 = x1 - x1 % bw, min(x2 + (-x2) % bw, self.width)
+        y1, y2 = y1 - y1 % bh, min(y2 + (-y2) % bh, self.height)
+        win = self.read_window(x1, y1, x2, y2)
+        self.mask(win)
+        return win
 
     def load_rgba(self):
-        ds = osgeo.gdal.Open(self.path)
-        band = ds.GetRasterBand(1)
-        data = band.ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize)
-        rct = band.GetRasterColorTable()
-        clut = []
-        for i in range(rct.GetCount()):
-            entry = rct.GetColorEntry(i)
-            clut.append((entry[0], entry[1], entry[2], entry[3]))
-        clut = numpy.array(clut, dtype='uint8')
-        rgba = numpy.empty((ds.RasterYSize, ds.RasterXSize, 4), dtype='uint8')
-        for i in range(4):
-            rgba[...,i] = cv2.LUT(data, clut[:,i])
-        self.rgba = rgba
+        self.window = self.read_window(0, 0, self.width, self.height)
+        self.rgba = self.window.rgba
+
+    def mask(self, win=None):
+        if (win or self.window).masked:
+            return
+        if vectorized_notes:
+            self.fade_cuts(20, win)
+        else:
+            self.fade_edges(20, win)
+            for args in self.notes:
+                self.apply(args, win)
 
-    def fade_edges(self, nsteps):
+    def fade_edges(self, nsteps, win=None):
+        win = win or self.window
         alpha = (numpy.arange(0, nsteps) / nsteps)[None,...]
-        self.rgba[:, 0:nsteps, 3] = self.rgba[:, 0:nsteps, 3] * alpha
-        self.rgba[:, -nsteps:, 3] = self.rgba[:, -nsteps:, 3] * numpy.flip(alpha, 1)
+        win.fade(0, 0, nsteps, self.height, alpha)
+        win.fade(self.width-nsteps, 0, self.width, self.height, numpy.flip(alpha, 1))
         alpha = alpha.transpose()
-        self.rgba[0:nsteps, :, 3] = self.rgba[0:nsteps, :, 3] * alpha
-        self.rgba[-nsteps:, :, 3] = self.rgba[-nsteps:, :, 3] * numpy.flip(alpha, 0)
+        win.fade(0, 0, self.width, nsteps, alpha)
+        win.fade(0, self.height-nsteps, self.width, self.height, numpy.flip(alpha, 0))
 
     def xy2lonlat(self, xy):
         x, y = self.forward_transform * (xy[0], xy[1])
@@ -217,79 +809,212 @@ class ChartFile:
         if lastxy is not None:
             yield from self.enum_xy(lastxy, lastxy)
 
-    def apply(self, args):
+    # a line from start to stop in pixels, projected in one batch
+    def line_xy(self, start, stop, step=0.1):
+        if start[0] > 0 and stop[0] < 0:
+            stop = (stop[0] + 360, stop[1])
+        n = max(1, math.ceil(math.sqrt((stop[0] - start[0])**2 + (stop[1] - start[1])**2) / step))
+        t = numpy.linspace(0, 1, n+1)
+        lon = start[0] + (stop[0] - start[0]) * t
+        lat = start[1] + (stop[1] - start[1]) * t
+        lon = numpy.where(lon < 180, lon, lon - 360)
+        x, y = self.reverse_transform * self.proj(lon, lat)
+        return numpy.asarray(x), numpy.asarray(y)
+
+    # the x of a line at each row it crosses inside the chart, nan elsewhere
+    def line_rows(self, start, stop):
+        x, y = self.line_xy(start, stop)
+        return self.interp_line(y, x, self.height, self.width)
+
+    # the y of a line at each column it crosses inside the chart, nan elsewhere
+    def line_cols(self, start, stop):
+        x, y = self.line_xy(start, stop)
+        return self.interp_line(x, y, self.width, self.height)
+
+    # the rows (or columns) span the rounded ends of the line, like the scanlines
+    def interp_line(self, u, v, ulen, vlen):
+        result = numpy.full(ulen, numpy.nan)
+        order = numpy.argsort(u)
+        at = numpy.arange(max(0, round(float(u.min()))), min(ulen, round(float(u.max())) + 1))
+        if len(at) > 0:
+            vs = numpy.round(numpy.interp(at, u[order], v[order]))
+            inside = (vs >= 0) & (vs < vlen)
+            result[at[inside]] = vs[inside]
+        return result
+
+    def expand_notes(self, notes):
+        for args in notes:
+            if args[0] == 'bounds':
+                yield ('l-lon', args[1])
+                yield ('b-lat', args[2])
+                yield ('r-lon', args[3])
+                yield ('t-lat', args[4])
+            else:
+                yield args
+
+    #
+    # Compile the notes into one footprint: the left/right cut for every row,
+    # the top/bottom cut for every column, and the erased boxes, in pixels.
+    #
+    def compile_cuts(self):
+        e = self.edge
+        left = numpy.full(self.height, numpy.nan)
+        right = numpy.full(self.height, numpy.nan)
+        top = numpy.full(self.width, numpy.nan)
+        bottom = numpy.full(self.width, numpy.nan)
+        boxes = []
+
+        for args in self.expand_notes(self.notes):
+            if args[0] == 'l-lon':
+                lon = float(args[1])
+                numpy.fmax(left, self.line_rows((lon, self.lat_min - 0.1), (lon, self.lat_max + 0.1)), out=left)
+            elif args[0] == 'r-lon':
+                lon = float(args[1])
+                numpy.fmin(right, self.line_rows((lon, self.lat_min - 0.1), (lon, self.lat_max + 0.1)), out=right)
+            elif args[0] == 't-lat':
+                lat = float(args[1])
+                numpy.fmax(top, self.line_cols((self.lon_min - 0.1, lat), (self.lon_max + 0.1, lat)), out=top)
+            elif args[0] == 'b-lat':
+                lat = float(args[1])
+                numpy.fmin(bottom, self.line_cols((self.lon_min - 0.1, lat), (self.lon_max + 0.1, lat)), out=bottom)
+            elif args[0] == 'l-fix':
+                numpy.fmax(left, self.lonlat2xyr((float(args[1]), float(args[2])))[0], out=left)
+            elif args[0] == 'r-fix':
+                numpy.fmin(right, self.lonlat2xyr((float(args[1]), float(args[2])))[0], out=right)
+            elif args[0] == 't-fix':
+                numpy.fmax(top, self.lonlat2xyr((float(args[1]), float(args[2])))[1], out=top)
+            elif args[0] == 'b-fix':
+                numpy.fmin(bottom, self.lonlat2xyr((float(args[1]), float(args[2])))[1], out=bottom)
+            elif args[0] == 'l-line':
+                numpy.fmax(left, self.line_rows((float(args[1]), float(args[2])), (float(args[3]), float(args[4]))), out=left)
+            elif args[0] == 'r-line':
+                numpy.fmin(right, self.line_rows((float(args[1]), float(args[2])), (float(args[3]), float(args[4]))), out=right)
+            elif args[0] == 'box':
+                xy1 = self.lonlat2xyr((float(args[1]), float(args[2])))
+                xy2 = self.lonlat2xyr((float(args[3]), float(args[4])))
+                boxes.append((min(xy1[0], xy2[0]) - e, min(xy1[1], xy2[1]) - e, max(xy1[0], xy2[0]) + e, max(xy1[1], xy2[1]) + e))
+
+        self.cuts = (left, right, top, bottom, boxes)
+        return self.cuts
+
+    # the part of a per-row (or per-column) cut that falls in a window
+    def window_cut(self, cut, start, n):
+        result = numpy.full(n, numpy.nan)
+        i1, i2 = max(start, 0), min(start + n, len(cut))
+        if i1 < i2:
+            result[i1-start:i2-start] = cut[i1:i2]
+        return result
+
+    #
+    # Fade the edges and apply the compiled notes to a window. Each cut is applied
+    # in one vectorized pass over the band of pixels it affects: zero up to the cut,
+    # then a linear fade over the margin.
+    #
+    def fade_cuts(self, nsteps, win=None):
+        win = win or self.window
+        left, right, top, bottom, boxes = self.cuts or self.compile_cuts()
+        e = self.edge
+        m = self.margin
+
+        self.fade_edges(nsteps, win)
+
+        alpha = win.rgba[...,3]
+        fade_cut(alpha, self.window_cut(left, win.y, win.height) - win.x, e, m, 1)
+        fade_cut(alpha, self.window_cut(right, win.y, win.height) - win.x, e, m, -1)
+        fade_cut(alpha.T, self.window_cut(top, win.x, win.width) - win.y, e, m, 1)
+        fade_cut(alpha.T, self.window_cut(bottom, win.x, win.width) - win.y, e, m, -1)
+
+        for xmin, ymin, xmax, ymax in boxes:
+            x1, y1 = max(xmin - m, win.x), max(ymin - m, win.y)
+            x2, y2 = min(xmax + m, win.x + win.width), min(ymax + m, win.y + win.height)
+            if x1 < x2 and y1 < y2:
+                x = numpy.arange(x1, x2)[None, :]
+                y = numpy.arange(y1, y2)[:, None]
+                d = numpy.maximum(numpy.maximum(xmin - x, x - (xmax - 1)), numpy.maximum(ymin - y, y - (ymax - 1)))
+                dst = alpha[y1-win.y:y2-win.y, x1-win.x:x2-win.x]
+                dst[...] = dst * ramp(d, m)
+
+    # pixels along a note line, computed once and shared by all windows
+    def note_points(self, start, stop):
+        key = (start, stop)
+        if key not in self.points:
+            self.points[key] = numpy.array(list(self.between_latlon(start, stop)), dtype='int64').reshape(-1, 2)
+        return self.points[key]
+
+    def apply(self, args, win=None):
+        win = win or self.window
         e = self.edge
         m = self.margin
 
         if args[0] == 'l-lon':
             lon = float(args[1])
-            alpha = (numpy.arange(0, m) / m)
-            for x, y in self.between_latlon((lon, self.lat_min - 0.1), (lon, self.lat_max + 0.1)):
-                self.rgba[y, 0:x+e, 3] = 0
-                self.rgba[y, x+e:x+e+m, 3] = self.rgba[y, x+e:x+e+m, 3] * alpha
+            alpha = (numpy.arange(0, m) / m)[None, ...]
+            for x, y in win.rows(self.note_points((lon, self.lat_min - 0.1), (lon, self.lat_max + 0.1))):
+                win.fade(0, y, x+e, y+1)
+                win.fade(x+e, y, x+e+m, y+1, alpha)
 
         elif args[0] == 'r-lon':
             lon = float(args[1])
-            alpha = numpy.flip(numpy.arange(0, m) / m)
-            for x, y in self.between_latlon((lon, self.lat_min - 0.1), (lon, self.lat_max + 0.1)):
-                self.rgba[y, x-e:, 3] = 0
-                self.rgba[y, x-e-m:x-e, 3] = self.rgba[y, x-e-m:x-e, 3] * alpha
+            alpha = numpy.flip(numpy.arange(0, m) / m)[None, ...]
+            for x, y in win.rows(self.note_points((lon, self.lat_min - 0.1), (lon, self.lat_max + 0.1))):
+                win.fade(x-e, y, self.width, y+1)
+                win.fade(x-e-m, y, x-e, y+1, alpha)
 
         elif args[0] == 't-lat':
             lat = float(args[1])
-            alpha = (numpy.arange(0, m) / m)
-            for x, y in self.between_latlon((self.lon_min - 0.1, lat), (self.lon_max + 0.1, lat)):
-                self.rgba[:y+e, x, 3] = 0
-                self.rgba[y+e:y+e+m, x, 3] = self.rgba[y+e:y+e+m, x, 3] * alpha
+            alpha = (numpy.arange(0, m) / m)[..., None]
+            for x, y in win.cols(self.note_points((self.lon_min - 0.1, lat), (self.lon_max + 0.1, lat))):
+                win.fade(x, 0, x+1, y+e)
+                win.fade(x, y+e, x+1, y+e+m, alpha)
 
         elif args[0] == 'b-lat':
             lat = float(args[1])
-            alpha = numpy.flip(numpy.arange(0, m) / m)
-            for x, y in self.between_latlon((self.lon_min - 0.1, lat), (self.lon_max + 0.1, lat)):
-                self.rgba[y-e:, x, 3] = 0
-                self.rgba[y-e-m:y-e, x, 3] = self.rgba[y-e-m:y-e, x, 3] * alpha
+            alpha = numpy.flip(numpy.arange(0, m) / m)[..., None]
+            for x, y in win.cols(self.note_points((self.lon_min - 0.1, lat), (self.lon_max + 0.1, lat))):
+                win.fade(x, y-e, x+1, self.height)
+                win.fade(x, y-e-m, x+1, y-e, alpha)
 
         elif args[0] == 'l-fix':
             x = self.lonlat2xyr((float(args[1]), float(args[2])))[0]
             alpha = (numpy.arange(0, m) / m)[None, ...]
-            self.rgba[:, 0:x+e, 3] = 0
-            self.rgba[:, x+e:x+e+m, 3] = self.rgba[:, x+e:x+e+m, 3] * alpha
+            win.fade(0, 0, x+e, self.height)
+            win.fade(x+e, 0, x+e+m, self.height, alpha)
 
         elif args[0] == 'r-fix':
             x = self.lonlat2xyr((float(args[1]), float(args[2])))[0]
             alpha = numpy.flip(numpy.arange(0, m) / m)[None, ...]
-            self.rgba[:, x-e:, 3] = 0
-            self.rgba[:, x-e-m:x-e, 3] = self.rgba[:, x-e-m:x-e, 3] * alpha
+            win.fade(x-e, 0, self.width, self.height)
+            win.fade(x-e-m, 0, x-e, self.height, alpha)
 
         elif args[0] == 't-fix':
             y = self.lonlat2xyr((float(args[1]), float(args[2])))[1]
             alpha = (numpy.arange(0, m) / m)[..., None]
-            self.rgba[0:y+e, :, 3] = 0
-            self.rgba[y+e:y+e+m, :, 3] = self.rgba[y+e:y+e+m, :, 3] * alpha
+            win.fade(0, 0, self.width, y+e)
+            win.fade(0, y+e, self.width, y+e+m, alpha)
 
         elif args[0] == 'b-fix':
             y = self.lonlat2xyr((float(args[1]), float(args[2])))[1]
             alpha = numpy.flip(numpy.arange(0, m) / m)[..., None]
-            self.rgba[y-e:, :, 3] = 0
-            self.rgba[y-e-m:y-e, :, 3] = self.rgba[y-e-m:y-e, :, 3] * alpha
+            win.fade(0, y-e, self.width, self.height)
+            win.fade(0, y-e-m, self.width, y-e, alpha)
 
         elif args[0] == 'l-line':
-            alpha = (numpy.arange(0, m) / m)
-            for x, y in self.between_latlon((float(args[1]), float(args[2])), (float(args[3]), float(args[4]))):
-                self.rgba[y, 0:x+e, 3] = 0
-                self.rgba[y, x+e:x+e+m, 3] = self.rgba[y, x+e:x+e+m, 3] * alpha
+            alpha = (numpy.arange(0, m) / m)[None, ...]
+            for x, y in win.rows(self.note_points((float(args[1]), float(args[2])), (float(args[3]), float(args[4])))):
+                win.fade(0, y, x+e, y+1)
+                win.fade(x+e, y, x+e+m, y+1, alpha)
 
         elif args[0] == 'r-line':
-            alpha = (numpy.arange(0, m) / m)
-            for x, y in self.between_latlon((float(args[1]), float(args[2])), (float(args[3]), float(args[4]))):
-                self.rgba[y, x-e:, 3] = 0
-                self.rgba[y, x-e-m:x-e, 3] = self.rgba[y, x-e-m:x-e, 3] * alpha
+            alpha = numpy.flip(numpy.arange(0, m) / m)[None, ...]
+            for x, y in win.rows(self.note_points((float(args[1]), float(args[2])), (float(args[3]), float(args[4])))):
+                win.fade(x-e, y, self.width, y+1)
+                win.fade(x-e-m, y, x-e, y+1, alpha)
 
         elif args[0] == 'bounds':
-            self.apply(('l-lon', args[1]))
-            self.apply(('b-lat', args[2]))
-            self.apply(('r-lon', args[3]))
-            self.apply(('t-lat', args[4]))
+            self.apply(('l-lon', args[1]), win)
+            self.apply(('b-lat', args[2]), win)
+            self.apply(('r-lon', args[3]), win)
+            self.apply(('t-lat', args[4]), win)
 
         elif args[0] == 'box':
             xy1 = self.lonlat2xyr((float(args[1]), float(args[2])))
@@ -298,7 +1023,7 @@ class ChartFile:
             xmax = min(self.width, max(xy1[0], xy2[0]) + e)
             ymin = max(0, min(xy1[1], xy2[1]) - e)
             ymax = min(self.height, max(xy1[1], xy2[1]) + e)
-            self.rgba[ymin:ymax, xmin:xmax, 3] = 0
+            win.fade(xmin, ymin, xmax, ymax)
             xmin = max(0, xmin - m)
             xmax = min(self.width, xmax + m)
             ymin = max(0, ymin - m)
@@ -306,10 +1031,10 @@ class ChartFile:
 
             for i in range(0, m):
                 alpha = 1.0 - i / m
-                self.rgba[ymin+i:ymax-i, xmin+i, 3] = self.rgba[ymin+i:ymax-i, xmin+i, 3] * alpha
-                self.rgba[ymin+i:ymax-i, xmax-i-1, 3] = self.rgba[ymin+i:ymax-i, xmax-i-1, 3] * alpha
-                self.rgba[ymin+i, xmin+i+1:xmax-i-1, 3] = self.rgba[ymin+i, xmin+i+1:xmax-i-1, 3] * alpha
-                self.rgba[ymax-i-1, xmin+i+1:xmax-i-1, 3] = self.rgba[ymax-i-1, xmin+i+1:xmax-i-1, 3] * alpha
+                win.fade(xmin+i, ymin+i, xmin+i+1, ymax-i, alpha)
+                win.fade(xmax-i-1, ymin+i, xmax-i, ymax-i, alpha)
+                win.fade(xmin+i+1, ymin+i, xmax-i-1, ymin+i+1, alpha)
+                win.fade(xmin+i+1, ymax-i-1, xmax-i-1, ymax-i, alpha)
 
     def check_lon(self, args, lon, margin=1.0):
         if self.lon_min > 90 and self.lon_max < -90:
@@ -340,20 +1065,57 @@ class ChartFile:
             else:
                 print("{self}: invalid args {args}")
 
-    def extract_tile(self, rect, size=(256,256), borderValue=(0, 0, 0, 0)):
-        #print("extract_tile", self.rgba.shape, rect)
+    # warp a tile with the homography of its corners, or on a remap grid
+    def extract_tile(self, rect, size=(256,256), borderValue=(0, 0, 0, 0), win=None, grid=None):
+        win = win or self.window
+        if grid is not None:
+            return cv2.remap(win.rgba, grid, None, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=borderValue)
+        #print("extract_tile", win.rgba.shape, rect)
 
         # REMIND: pick best resolution
         #w = rect[1][0] - rect[0][0]
         #if w > size[0]*2 or w*2 < size[0]:
         #    print("warining: losing resolution", size[0]/w)
 
-        src_rect = numpy.array(rect, dtype='float32')
-        dst_rect = numpy.array([(0,0), (size[0], 0), size, (0, size[1])], dtype='float32')
-        mat = cv2.getPerspectiveTransform(src_rect, dst_rect)
-        return cv2.warpPerspective(self.rgba, mat, size, borderValue=borderValue)
+        return cv2.warpPerspective(win.rgba, self.tile_transform(rect, size, win), size, borderValue=borderValue)
 
-    def save_tiles(self, level, overwrite, touched):
+    def tile_transform(self, rect, size, win):
+        src_rect = numpy.array(rect, dtype='float32') - numpy.array((win.x, win.y), dtype='float32')
+        dst_rect = numpy.array([(0,0), (size[0], 0), size, (0, size[1])], dtype='float32')
+        return cv2.getPerspectiveTransform(src_rect, dst_rect)
+
+    # the palette indices of a tile, nearest neighbour, or None if the tile is not fully opaque
+    def extract_index(self, rect, size=(256,256), win=None, grid=None):
+        win = win or self.window
+        if grid is not None:
+            alpha = cv2.remap(win.rgba[...,3], grid, None, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+            if alpha.min() < 255:
+                return None
+            return cv2.remap(win.index, grid, None, cv2.INTER_NEAREST)
+        mat = self.tile_transform(rect, size, win)
+        alpha = cv2.warpPerspective(win.rgba[...,3], mat, size, borderValue=0)
+        if alpha.min() < 255:
+            return None
+        return cv2.warpPerspective(win.index, mat, size, flags=cv2.INTER_NEAREST)
+
+    # load the part of the chart behind a block of tiles, the tiles that are projected
+    # exactly can bulge out of their corners by their error
+    def load_block(self, block):
+        if not windowed_charts:
+            return self.window
+        pts = numpy.array([xy for _, _, rect, _ in block for xy in rect])
+        bulge = max([0] + [error * numpy.linalg.norm(rect[1] - rect[0]) / tile_size for _, _, rect, error in block if warp_error_budget is not None and error > warp_error_budget])
+        x1, y1 = numpy.floor(pts.min(axis=0) - bulge).astype(int) - warp_margin
+        x2, y2 = numpy.ceil(pts.max(axis=0) + bulge).astype(int) + warp_margin
+        return self.load_window(max(x1, 0), max(y1, 0), min(x2, self.width), min(y2, self.height))
+
+    #
+    # The corners of all tiles of a level that overlap the chart, in chart pixels.
+    # The corner grid of the whole tile range is projected in one batch and the
+    # tiles are culled with a vectorized boundary check, and against the footprint.
+    # Returns arrays tx, ty (unwrapped) and rects with shape (n, 4, 2).
+    #
+    def tile_rects(self, level):
         xy = level.lonlat2xy((self.lon_min, self.lat_max))
         tile_min = (round(xy[0]) // tile_size, round(xy[1]) // tile_size)
         xy = level.lonlat2xy((self.lon_max, self.lat_min))
@@ -362,32 +1124,247 @@ class ChartFile:
         if tile_max[0] < tile_min[0]:
             tile_max = (tile_max[0] + level.tile_count, tile_max[1])
 
-        count = 0
-        for tx in range(tile_min[0]-1, tile_max[0]+1):
-            tx = tx % level.tile_count
-            tile_dir = os.path.join(level.dir, f"{tx}")
-            if not os.path.exists(tile_dir):
-                os.mkdir(tile_dir)
-            for ty in range(tile_min[1]-1, tile_max[1]+1):
-                tile_path = os.path.join(tile_dir, f"{ty}.png")
-
-                rect = [
-                    self.lonlat2xy(level.xy2lonlat(((tx + xy[0]) * tile_size, (ty + xy[1])*tile_size))) for xy in [(0, 0), (1, 0), (1, 1), (0, 1)]
-                ]
-
-                # boundary check
-                if max(rect[1][0], rect[2][0]) <= 0 or min(rect[0][0], rect[3][0]) >= self.rgba.shape[1] or min(rect[2][1], rect[3][1]) <= 0 or max(rect[0][1], rect[1][1]) >= self.rgba.shape[0]:
-                    continue
-
-                count += 1
-                tile = self.extract_tile(rect, (tile_size, tile_size))
-
-                tmpfile = f"/tmp/{hashlib.md5(tile_path.encode('utf-8')).hexdigest()}.lock"
-                with filelock.FileLock(tmpfile):
-                    if os.path.exists(tile_path) and not overwrite:
-                        combine_tiles(tile, numpy.asarray(PIL.Image.open(tile_path)))
-                    if write_tile(tile_path, tile):
-                        touched.append((tx, ty))
+        # project the shared corners of the tile grid
+        tx = numpy.arange(tile_min[0]-1, tile_max[0]+1)
+        ty = numpy.arange(tile_min[1]-1, tile_max[1]+1)
+        px, py = numpy.meshgrid(numpy.arange(tx[0], tx[-1]+2) * tile_size, numpy.arange(ty[0], ty[-1]+2) * tile_size)
+        mx, my = level.forward_transform * (px, py)
+        x, y = self.reverse_transform * transformer(level.proj.srs, self.proj.srs).transform(mx, my)
+        x, y = numpy.asarray(x), numpy.asarray(y)
+
+        # corners (0, 0), (1, 0), (1, 1), (0, 1) of every tile, indexed [ty, tx]
+        rects = numpy.stack([
+            numpy.stack((x[:-1,:-1], y[:-1,:-1]), axis=-1),
+            numpy.stack((x[:-1,1:], y[:-1,1:]), axis=-1),
+            numpy.stack((x[1:,1:], y[1:,1:]), axis=-1),
+            numpy.stack((x[1:,:-1], y[1:,:-1]), axis=-1),
+        ], axis=2)
+
+        # boundary check
+        keep = numpy.isfinite(rects).all(axis=(2, 3))
+        keep &= numpy.maximum(rects[:,:,1,0], rects[:,:,2,0]) > 0
+        keep &= numpy.minimum(rects[:,:,0,0], rects[:,:,3,0]) < self.width
+        keep &= numpy.minimum(rects[:,:,2,1], rects[:,:,3,1]) > 0
+        keep &= numpy.maximum(rects[:,:,0,1], rects[:,:,1,1]) < self.height
+
+        tys, txs = numpy.nonzero(keep)
+        rects = rects[tys, txs]
+
+        # footprint check
+        if footprint_tiles and len(rects) > 0:
+            inside = shapely.intersects(shapely.polygons(rects), self.footprint())
+            tys, txs, rects = tys[inside], txs[inside], rects[inside]
+        return tx[txs], ty[tys], rects
+
+    #
+    # The footprint of the chart, the part that the notes leave, as a polygon in chart
+    # pixels. The cuts are sampled every step rows and columns, and the polygon is
+    # grown by step so that no tile with chart pixels is left out. It only needs the
+    # notes and the georeference, not the raster.
+    #
+    def footprint(self, step=16):
+        if self.shape is None:
+            left, right, top, bottom, boxes = self.cuts or self.compile_cuts()
+            e = self.edge
+
+            rows = numpy.append(numpy.arange(0, self.height, step), self.height - 1)
+            x2 = numpy.clip(numpy.nan_to_num(right[rows] - e, nan=self.width), 0, self.width)
+            x1 = numpy.minimum(numpy.clip(numpy.nan_to_num(left[rows] + e, nan=0), 0, self.width), x2)
+            cols = numpy.append(numpy.arange(0, self.width, step), self.width - 1)
+            y2 = numpy.clip(numpy.nan_to_num(bottom[cols] - e, nan=self.height), 0, self.height)
+            y1 = numpy.minimum(numpy.clip(numpy.nan_to_num(top[cols] + e, nan=0), 0, self.height), y2)
+
+            shape = shapely.make_valid(shapely.Polygon(list(zip(x1, rows)) + list(zip(x2, rows))[::-1]))
+            shape = shape.intersection(shapely.make_valid(shapely.Polygon(list(zip(cols, y1)) + list(zip(cols, y2))[::-1])))
+            for box in boxes:
+                shape = shape.difference(shapely.box(*box))
+            self.shape = shape.buffer(step)
+            shapely.prepare(self.shape)
+        return self.shape
+
+    # the tiles of this chart at a level, with tx wrapped around the map
+    def tile_set(self, level):
+        tx, ty, _ = self.tile_rects(level)
+        tiles = set(zip((tx % level.tile_count).tolist(), ty.tolist()))
+        return tiles if self.only is None else tiles & self.only
+
+    # the tiles of a level that overlap changed blocks, with tx wrapped around the map
+    def changed_tiles(self, level, changed):
+        tx, ty, rects = self.tile_rects(level)
+        errors = self.tile_errors(level, tx, ty, rects) if warp_error_budget is not None else numpy.zeros(len(rects))
+        bulge = numpy.where(errors > (warp_error_budget or 0), errors * numpy.linalg.norm(rects[:,1] - rects[:,0], axis=-1) / tile_size, 0)[:,None]
+        lo = (numpy.floor(rects.min(axis=1) - bulge).astype(int) - warp_margin) // diff_block
+        hi = (numpy.ceil(rects.max(axis=1) + bulge).astype(int) + warp_margin) // diff_block + 1
+        x1, x2 = numpy.clip(lo[:,0], 0, changed.shape[1]), numpy.clip(hi[:,0], 0, changed.shape[1])
+        y1, y2 = numpy.clip(lo[:,1], 0, changed.shape[0]), numpy.clip(hi[:,1], 0, changed.shape[0])
+        sums = numpy.pad(changed.astype('int64').cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+        keep = (sums[y2, x2] - sums[y1, x2] - sums[y2, x1] + sums[y1, x1]) > 0
+        return set(zip((tx[keep] % level.tile_count).tolist(), ty[keep].tolist()))
+
+    # the remap grid of a tile, its inverse homography evaluated on a lattice
+    def tile_grid(self, rect, win, step=warp_grid_step):
+        m = numpy.linalg.inv(self.tile_transform(rect, (tile_size, tile_size), win))
+        u = grid_lattice(step)[None, :]
+        v = u.T
+        w = m[2,0] * u + m[2,1] * v + m[2,2]
+        return upsample_grid(numpy.stack(((m[0,0] * u + m[0,1] * v + m[0,2]) / w, (m[1,0] * u + m[1,1] * v + m[1,2]) / w), axis=-1), step)
+
+    # the remap grid of a tile with the lattice projected exactly, in one batch
+    def projected_grid(self, level, tx, ty, win, step=warp_grid_step):
+        px, py = numpy.meshgrid(tx * tile_size + grid_lattice(step), ty * tile_size + grid_lattice(step))
+        mx, my = level.forward_transform * (px, py)
+        x, y = self.reverse_transform * transformer(level.proj.srs, self.proj.srs).transform(mx, my)
+        return upsample_grid(numpy.stack((numpy.asarray(x) - win.x, numpy.asarray(y) - win.y), axis=-1), step)
+
+    #
+    # The error of the homography of each tile, in tile pixels: the distance from
+    # where its corners put the midpoints of its edges and its center, to where
+    # they are projected. The error grows with the size of the tile on the ground.
+    #
+    def tile_errors(self, level, tx, ty, rects):
+        mids = numpy.array([(0.5, 0), (1, 0.5), (0.5, 1), (0, 0.5), (0.5, 0.5)])
+        if len(rects) == 0:
+            return numpy.zeros(0)
+        px = (tx[:, None] + mids[None, :, 0]) * tile_size
+        py = (ty[:, None] + mids[None, :, 1]) * tile_size
+        mx, my = level.forward_transform * (px, py)
+        x, y = self.reverse_transform * transformer(level.proj.srs, self.proj.srs).transform(mx, my)
+
+        corners = numpy.array([(0, 0), (tile_size, 0), (tile_size, tile_size), (0, tile_size)], dtype='float32')
+        mats = numpy.array([cv2.getPerspectiveTransform(corners, rect.astype('float32')) for rect in rects])
+        pts = numpy.concatenate((mids * tile_size, numpy.ones((len(mids), 1))), axis=1)
+        approx = numpy.einsum('nij,kj->nki', mats, pts)
+        approx = approx[...,:2] / approx[...,2:]
+        error = numpy.hypot(approx[...,0] - numpy.asarray(x), approx[...,1] - numpy.asarray(y)).max(axis=1)
+        return error * tile_size / numpy.linalg.norm(rects[:,1] - rects[:,0], axis=1)
+
+    #
+    # Warp a group of tiles with one remap call, on the remap grids of the tiles.
+    # Returns the tiles by (tx, ty), and when index is set the palette indices of
+    # the fully opaque tiles.
+    #
+    def remap_tiles(self, level, group, win, index=False):
+        tx = numpy.array([t[0] for t in group])
+        ty = numpy.array([t[1] for t in group])
+        x0, y0 = tx.min(), ty.min()
+        grid = numpy.full(((ty.max() - y0 + 1) * tile_size, (tx.max() - x0 + 1) * tile_size, 2), -1, dtype='float32')
+        for x, y, rect, error in group:
+            dense = warp_error_budget is not None and error > warp_error_budget
+            grid[(y - y0) * tile_size:(y - y0 + 1) * tile_size, (x - x0) * tile_size:(x - x0 + 1) * tile_size] = self.projected_grid(level, x, y, win) if dense else self.tile_grid(rect, win)
+        rgba = cv2.remap(win.rgba, grid, None, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0, 0))
+
+        tiles = {}
+        indices = {}
+        for x, y, _, _ in group:
+            ys, xs = slice((y - y0) * tile_size, (y - y0 + 1) * tile_size), slice((x - x0) * tile_size, (x - x0 + 1) * tile_size)
+            tiles[(x, y)] = rgba[ys, xs].copy()
+            if index and tiles[(x, y)][...,3].min() == 255:
+                indices[(x, y)] = (ys, xs)
+        if len(indices) > 0:
+            warped = cv2.remap(win.index, grid, None, cv2.INTER_NEAREST)
+            indices = {xy: warped[ys, xs].copy() for xy, (ys, xs) in indices.items()}
+        return tiles, indices
+
+    # the tiles of a level as (tx, ty, rect, error), with tx wrapped around the map
+    def tile_list(self, level):
+        tx, ty, rects = self.tile_rects(level)
+        errors = self.tile_errors(level, tx, ty, rects) if warp_error_budget is not None else numpy.zeros(len(rects))
+        return list(zip(tx % level.tile_count, ty, rects, errors))
+
+    # group tiles in blocks of n x n tiles, a block never spans the wrap around
+    def tile_groups(self, tiles, n):
+        groups = {}
+        for t in tiles:
+            groups.setdefault((t[0] // n, t[1] // n), []).append(t)
+        return list(groups.values())
+
+    #
+    # Warp the tiles of a block, opaque tiles of one chart as palette indices. Tiles
+    # with an error over warp_error_budget are warped on a projected grid, the others
+    # with the homography of their corners. With warp_tiles set, the tiles are warped
+    # in groups of warp_tiles x warp_tiles tiles. Returns the tiles and the time spent.
+    #
+    def warp_block(self, router, block):
+        win = self.load_block(block)
+        if self.only is not None:
+            block = [t for t in block if (t[0], t[1]) in self.only]
+        level = router.level
+        indexed = win.index is not None and level.store.indexed
+        stats = {}
+        if warp_tiles > 0:
+            tm = time.time()
+            warped = {}
+            warped_indices = {}
+            for group in self.tile_groups(block, warp_tiles):
+                tiles, indices = self.remap_tiles(level, group, win, indexed)
+                warped.update(tiles)
+                warped_indices.update(indices)
+            stats['remap_time'] = time.time() - tm
+
+        tiles = []
+        for tx, ty, rect, error in block:
+            if warp_tiles > 0:
+                if (tx, ty) in warped_indices and (tx, ty) not in router.shared:
+                    tiles.append((int(tx), int(ty), warped_indices[(tx, ty)], True))
+                else:
+                    tiles.append((int(tx), int(ty), warped[(tx, ty)], False))
+                continue
+
+            tm = time.time()
+            dense = warp_error_budget is not None and error > warp_error_budget
+            grid = self.projected_grid(level, tx, ty, win) if dense else None
+            tile = None
+            if indexed and (tx, ty) not in router.shared:
+                tile = self.extract_index(rect, (tile_size, tile_size), win=win, grid=grid)
+            if tile is not None:
+                tiles.append((int(tx), int(ty), tile, True))
+            else:
+                tiles.append((int(tx), int(ty), self.extract_tile(rect, (tile_size, tile_size), win=win, grid=grid), False))
+            tile_store.add_stats(stats, {'dense_time' if dense else 'warp_time': time.time() - tm})
+        return tiles, stats
+
+    def put_tiles(self, router, order, warped, touched, stats):
+        tiles, block_stats = warped
+        tile_store.add_stats(stats, block_stats)
+        for tx, ty, tile, indexed in tiles:
+            if indexed:
+                router.put_index(tx, ty, tile, self.clut[:,:3], touched)
+            else:
+                router.put(tx, ty, order, tile, touched)
+
+    #
+    # The blocks are read and warped by chart_threads threads, which share the chart
+    # and its notes. The tiles are written by this thread, in block order, and encoded
+    # by the encoder threads of the store, with at most 2*chart_threads blocks in flight.
+    #
+    def save_tiles(self, router, order, touched):
+        tiles = self.tile_list(router.level)
+        blocks = self.tile_groups(tiles, tile_block)
+        if self.only is not None:
+            # the blocks keep all their tiles, so that the windows are the same as in a full run
+            blocks = [block for block in blocks if any((t[0], t[1]) in self.only for t in block)]
+        stats = {}
+
+        if chart_threads <= 1:
+            for block in blocks:
+                self.put_tiles(router, order, self.warp_block(router, block), touched, stats)
+        else:
+            self.load_clut()
+            if chart_cache:
+                self.cached()
+            elif windowed_charts and vectorized_notes and self.cuts is None:
+                self.compile_cuts()
+            with concurrent.futures.ThreadPoolExecutor(chart_threads) as pool:
+                pending = collections.deque()
+                for block in blocks:
+                    pending.append(pool.submit(self.warp_block, router, block))
+                    if len(pending) >= 2*chart_threads:
+                        self.put_tiles(router, order, pending.popleft().result(), touched, stats)
+                while len(pending) > 0:
+                    self.put_tiles(router, order, pending.popleft().result(), touched, stats)
+
+        if warp_error_budget is not None and len(tiles) > 0:
+            print(f"{self}: {warp_error_str([error for _, _, _, error in tiles])}, {warp_stats_str(stats)}")
 
     def save(self, filename):
         tm = time.time()
@@ -399,141 +1376,837 @@ class ChartFile:
         return f"ChartFile({self.name}, {self.width}x{self.height}, zoom={self.zoom})"
 
 #
-# Process charts using multiple workers
+# Build the lower zoom levels in one pass. The tiles of src_zoom are grouped in
+# superblocks, the tiles of dst_zoom, which are handed out in Z-order. A worker
+# decodes each source tile of a superblock once and keeps the levels in between
+# in memory, as premultiplied fixed point tiles filtered down 2x2 at a time.
 #
-def process_chart(inq, outq, level, overwrite):
-    touched = []
-    while True:
-        chart = inq.get()
-        if chart[0] == 'done':
-            break
-        cf = chart[1]
 
-        if False and os.path.exists(os.path.join(settings.tmp_dir, cf.name.replace(' ', '_') + ".png")):
-            continue
+# build a tile from the tiles below it, returns it premultiplied or None. Tiles
+# without touched source tiles below them are not rebuilt but read as they are.
+def pyramid_tile(store, zoom, tx, ty, src_zoom, present, counts):
+    if zoom == src_zoom or (zoom, tx, ty) not in present:
+        tile = store.read_tile(zoom, tx, ty)
+        return premultiply(tile) if tile is not None else None
 
-        try:
-            print(f"processing {cf}...")
+    s = tile_size
+    tmp = None
+    for offx in range(2):
+        for offy in range(2):
+            child = pyramid_tile(store, zoom+1, tx*2 + offx, ty*2 + offy, src_zoom, present, counts)
+            if child is not None:
+                if tmp is None:
+                    tmp = numpy.zeros((s*2, s*2, 4), dtype='uint16')
+                tmp[s*offy:s*offy+s, s*offx:s*offx+s] = child
+    if tmp is None:
+        return None
+    tile = downsample(tmp)
+    if write_tile(store, zoom, tx, ty, unpremultiply(tile)):
+        counts[zoom] = counts.get(zoom, 0) + 1
+    return tile
+
+# build the superblock of touched source tiles, and the tiles above them
+def pyramid_block(store, src_zoom, dst_zoom, block, counts):
+    present = set()
+    for zoom in range(src_zoom, dst_zoom-1, -1):
+        shift = src_zoom - zoom
+        present.update((zoom, tx, ty) for tx, ty in zip((block[:,0] >> shift).tolist(), (block[:,1] >> shift).tolist()))
+    shift = src_zoom - dst_zoom
+    pyramid_tile(store, dst_zoom, int(block[0,0] >> shift), int(block[0,1] >> shift), src_zoom, present, counts)
+
+# the touched tiles grouped in superblocks, in Z-order
+def pyramid_blocks(tiles, depth):
+    codes = util.morton_code(tiles[:,0] >> depth, tiles[:,1] >> depth)
+    order = numpy.argsort(codes, kind='stable')
+    tiles, codes = tiles[order], codes[order]
+    return numpy.split(tiles, numpy.flatnonzero(codes[1:] != codes[:-1]) + 1)
+
+# build the pyramid above the tiles in this process, the tile pool hands out the
+# same blocks to its workers
+def build_pyramid(store, tiles, src_zoom, dst_zoom):
+    counts = {}
+    for block in pyramid_blocks(tiles, src_zoom - dst_zoom):
+        pyramid_block(store, src_zoom, dst_zoom, block, counts)
+    return counts
+
+# the lowest level that the pyramid can build from zoom, charts are added at their own zoom
+def pyramid_zoom(zoom, charts):
+    return max([zoom - pyramid_depth, 0] + [chart.zoom for chart in charts if chart.zoom < zoom])
+
+# the number of tiles of a layer at each zoom level, from the chart footprints
+def predict_tiles(levels, charts):
+    counts = {}
+    tiles = set()
+    for zoom in range(len(levels)-1, -1, -1):
+        tiles = {(tx >> 1, ty >> 1) for tx, ty in tiles}
+        for chart in charts:
+            if chart.zoom == zoom:
+                tiles |= chart.tile_set(levels[zoom])
+        counts[zoom] = len(tiles)
+    return counts
 
-            # load rgba image
-            cf.load_rgba()
-            cf.fade_edges(nsteps=20)
+#
+# Provenance: the charts that the tiles of a layer were made from, with their
+# versions and their tiles as Morton codes. It is saved next to the tiles when
+# a layer is done, so that the next run only has to redo the changed charts.
+#
+def load_provenance(store, max_zoom):
+    path = store.provenance_path()
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        provenance = json.load(f)
+    if (provenance.get('format'), provenance.get('tile_size'), provenance.get('max_zoom')) != (store.format, tile_size, max_zoom):
+        print(f"{store}: tiles were made with different settings")
+        return None
+    return provenance
+
+def save_provenance(store, max_zoom, charts, tile_sets):
+    provenance = {'format': store.format, 'tile_size': tile_size, 'max_zoom': max_zoom, 'charts': {}}
+    for chart in charts:
+        provenance['charts'][chart.name] = {
+            'path': chart.path,
+            'date': chart.date,
+            'version': chart.version(),
+            'layout': chart.layout(),
+            'zoom': chart.zoom,
+            'tiles': encode_tiles(tile_sets[chart.name]),
+        }
+    path = store.provenance_path()
+    with open(path + ".new", 'w') as f:
+        json.dump(provenance, f)
+    os.replace(path + ".new", path)
 
-            # process notes
-            for args in settings.chart_notes[cf.name]:
-                cf.apply(args)
+#
+# Throughput: per layer, the tiles that the charts warped and the tiles that the
+# pyramid built in the last run, with the seconds the workers spent on them, and
+# the tiles that were stored with the bytes they took.
+#
+def load_throughput():
+    if not os.path.exists(settings.chart_throughput_file):
+        return {}
+    with open(settings.chart_throughput_file) as f:
+        return json.load(f)
 
-            # save tiles
-            if save_chart_tiles:
-                cf.save_tiles(level, overwrite, touched)
+def save_throughput(throughput):
+    with open(settings.chart_throughput_file + ".tmp", "w") as f:
+        json.dump(throughput, f, indent=1, sort_keys=True)
+    os.replace(settings.chart_throughput_file + ".tmp", settings.chart_throughput_file)
 
-            # same map image (slow, for debugging only)
-            if save_chart_images:
-                cf.save(os.path.join(settings.tmp_dir, cf.name.replace(' ', '_') + ".png"))
-        except:
-            print(f"{cf} failed")
-            traceback.print_exc()
+#
+# Plan a layer without tiling it. For each zoom level: the tiles that the charts
+# warp, once for each chart that covers them, the tiles that the charts and the
+# pyramid write, the tiles of the layer, and those not in its coverage index yet.
+# Nothing is written, the coverage index is not rebuilt when it is missing.
+# With provenance the charts only warp the tiles of the charts that changed or
+# were removed, in full, as the changed blocks are only known once they are read.
+# The size and the time come from the throughput of the last run of the layer.
+# A chart without tiles, or with little left after the notes, is flagged.
+#
+def plan_layer(store, kind, charts, throughput, min_footprint=0.25):
+    levels = make_levels(store, kind, max_zoom)
+    levels[0].coverage.load(store.coverage_path())
+    provenance = load_provenance(store, max_zoom) if incremental_tiles and os.path.exists(store.path) else None
+    old = provenance['charts'] if provenance is not None else {}
+    changed = {chart.name for chart in charts if chart.name not in old or old[chart.name]['version'] != chart.version()}
+    removed = [name for name in old if name not in {chart.name for chart in charts}]
+
+    tile_sets = {}
+    for chart in charts:
+        tile_sets[chart.name] = chart.tile_set(levels[chart.zoom])
+        kept = chart.footprint().area / (chart.width * chart.height)
+        check = ", check the notes" if len(tile_sets[chart.name]) == 0 or kept < min_footprint else ""
+        print(f"    {chart.name}: zoom {chart.zoom}, {len(tile_sets[chart.name]):,} tiles, footprint {100*min(kept, 1):.0f}% of the chart{', changed' if chart.name in changed else ''}{check}")
+
+    record = throughput.get(kind, {})
+    bytes_per_tile = record['bytes'] / record['tiles'] if record.get('tiles', 0) > 0 else 50*1024
+    warp_seconds = record['chart_seconds'] / record['warped'] if record.get('warped', 0) > 0 else None
+    build_seconds = record['pyramid_seconds'] / record['built'] if record.get('built', 0) > 0 else None
+
+    tiles = set()
+    dirty = set()
+    totals = {'warped': 0, 'built': 0, 'written': 0, 'tiles': 0}
+    for zoom in range(max_zoom, -1, -1):
+        tiles = {(tx >> 1, ty >> 1) for tx, ty in tiles}
+        dirty = {(tx >> 1, ty >> 1) for tx, ty in dirty}
+        built = len(dirty)
+        for chart in charts:
+            if chart.zoom == zoom:
+                tiles |= tile_sets[chart.name]
+                if chart.name in changed:
+                    dirty |= tile_sets[chart.name]
+        for name in removed:
+            if old[name]['zoom'] == zoom:
+                dirty |= decode_tiles(old[name]['tiles'])
+        warped = sum(len(tile_sets[chart.name] & dirty) for chart in charts if chart.zoom == zoom)
+        covered = {tuple(txy) for txy in levels[0].coverage.tiles(zoom).tolist()}
+        if len(tiles) > 0 or len(dirty) > 0:
+            print(f"    zoom {zoom}: {warped:,} tiles warped, {len(dirty & tiles):,} written, {len(tiles):,} tiles, {len(tiles - covered):,} new, {len(tiles)*bytes_per_tile/(1024*1024):,.0f}MB")
+        totals['warped'] += warped
+        totals['built'] += built
+        totals['written'] += len(dirty & tiles)
+        totals['tiles'] += len(tiles)
+
+    seconds = None
+    if warp_seconds is not None and (build_seconds is not None or totals['built'] == 0):
+        seconds = (totals['warped'] * warp_seconds + totals['built'] * (build_seconds or 0)) / min(max_chart_workers, os.cpu_count())
+    estimate = f"in {util.duration_str(seconds)}" if seconds is not None else "no earlier run to estimate the time"
+    print(f"{kind}: {len(changed)} of {len(charts)} charts to tile, {len(removed)} removed, {totals['warped']:,} tiles warped, {totals['written']:,} written, {totals['tiles']:,} tiles, {totals['tiles']*bytes_per_tile/(1024*1024*1024):.1f}GB, {estimate}")
+    return totals['tiles']*bytes_per_tile, seconds
 
-    outq.put(touched)
+#
+# Builds: a layer is built in a new version of its store, which is published when
+# the layer is done. The version starts as a copy of the live tiles when these
+# can be updated. The manifest of a build records the plan, the stages and the
+# charts that are done, so that the next run resumes a build that was interrupted.
+# A build with charts that failed is not published, the next run updates it with
+# the failed charts.
+#
+def load_manifest(store):
+    path = store.manifest_path()
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(store, manifest):
+    path = store.manifest_path()
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + ".new", 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + ".new", path)
+
+# the store to build a layer in, its manifest, and the provenance of the live tiles to update
+def stage_layer(live, charts):
+    versions = {chart.name: chart.version() for chart in charts}
+    published = live.published()
+    for build in reversed(live.builds()):
+        if build == published:
+            continue
+        manifest = load_manifest(live.version(build))
+        if manifest is not None and 'stage' in manifest and not manifest.get('complete') and manifest['versions'] == versions:
+            print(f"{live}: resuming build {build} at stage {manifest['stage']}, {len(manifest['charts'])} charts done")
+            return live.version(build), manifest, None
+        if manifest is not None and 'retry' in manifest and manifest['versions'] == versions:
+            provenance = load_provenance(live.version(build), max_zoom)
+            if provenance is not None:
+                print(f"{live}: retrying build {build} with {len(manifest['retry'])} charts that failed")
+                return live.version(build), {'build': build, 'versions': versions}, provenance
+        print(f"{live}: discarding build {build}")
+        live.discard(build)
+
+    provenance = load_provenance(live, max_zoom) if incremental_tiles and os.path.exists(live.path) else None
+    if provenance is not None and {name: chart['version'] for name, chart in provenance['charts'].items()} == versions:
+        print(f"{live}: up to date")
+        return live, None, provenance
+
+    build = time.strftime("%Y%m%d-%H%M%S")
+    if build == published:
+        build += f"-{os.getpid()}"
+    store = live.version(build)
+    if provenance is not None:
+        tm = time.time()
+        live.copy_to(store)
+        print(f"{live}: copied to build {build} in {util.time_str(tm)}")
+    return store, {'build': build, 'versions': versions}, provenance
+
+def encode_tiles(tiles):
+    tx, ty = numpy.array(list(tiles), dtype='int64').reshape(-1, 2).T
+    return numpy.sort(util.morton_code(tx, ty)).tolist()
+
+def decode_tiles(codes):
+    tx, ty = util.morton_decode(codes)
+    return set(zip(tx.tolist(), ty.tolist()))
 
-def process_charts(levels, zoom, charts, overwrite=False, max_workers=max_chart_workers):
-    if len(charts) > 0:
-        nworkers = min(max_workers, len(charts))
-        inq = ctx.Queue(nworkers*2)
-        outq = ctx.Queue(nworkers*2)
+# the dirty tiles of a build are saved once, next to the manifest
+def dirty_path(store):
+    return os.path.splitext(store.manifest_path())[0] + ".dirty.npz"
 
-        for _ in range(nworkers):
-            ctx.Process(target=process_chart, args=(inq, outq, levels[zoom], overwrite)).start()
+#
+# LayerJob: the stages of a layer, from the top zoom level down. The charts of
+# a zoom level are added to the tiles scaled down from the level above, and
+# the pyramid passes stop at the zoom levels that have charts.
+# Given the provenance of the last run only the dirty tiles are made again:
+# the tiles of the charts that changed or were removed, and their parents.
+# The dirty tiles are deleted first, and made again from all their charts.
+# With a manifest the stages and charts that are done are checkpointed, and
+# the layer is published when it is done.
+#
+class LayerJob:
+    def __init__(self, levels, charts, overwrite=False, provenance=None, manifest=None, live=None):
+        self.kind = levels[0].type
+        self.levels = levels
+        self.charts = charts
+        self.overwrite = overwrite
+        self.manifest = manifest
+        self.live = live
+        self.tm = time.time()
+        self.failed = set()
+        self.dirty = None
+        self.repairs = 0
+        self.throughput = {'warped': 0, 'chart_seconds': 0, 'built': 0, 'pyramid_seconds': 0}
+        self.tile_sets = {chart.name: chart.tile_set(levels[chart.zoom]) for chart in charts}
+        if manifest is not None and 'stage' in manifest:
+            self.failed = set(manifest['failed'])
+            if manifest['dirty']:
+                with numpy.load(dirty_path(levels[0].store)) as data:
+                    self.dirty = [decode_tiles(data[f"zoom{zoom}"]) for zoom in range(len(levels))]
+                charts = self.restrict()
+        elif provenance is not None:
+            charts = self.update(provenance)
+
+        passes = {}
+        src_zoom = len(levels)-1
+        while src_zoom > 0:
+            passes[src_zoom] = pyramid_zoom(src_zoom, charts)
+            src_zoom = passes[src_zoom]
+
+        self.stages = []
+        for zoom in range(len(levels)-1, -1, -1):
+            zoom_charts = [chart for chart in charts if chart.zoom == zoom]
+            if len(zoom_charts) > 0:
+                self.stages.append(('charts', zoom, zoom_charts))
+            if zoom in passes:
+                self.stages.append(('pyramid', zoom, passes[zoom], self.dirty))
+        self.stage = None
+
+        if manifest is not None:
+            if 'stage' in manifest:
+                self.resume()
+            else:
+                if self.dirty is not None:
+                    os.makedirs(os.path.dirname(dirty_path(levels[0].store)) or '.', exist_ok=True)
+                    numpy.savez(dirty_path(levels[0].store), **{f"zoom{zoom}": encode_tiles(tiles) for zoom, tiles in enumerate(self.dirty)})
+                manifest.update({'dirty': self.dirty is not None, 'stage': 0, 'charts': [], 'failed': []})
+                save_manifest(levels[0].store, manifest)
+
+    def update(self, provenance):
+        old = provenance['charts']
+        changed = [chart.name for chart in self.charts if chart.name not in old or old[chart.name]['version'] != chart.version()]
+        removed = [name for name in old if name not in self.tile_sets]
+
+        # the charts with an earlier edition of the same layout only redo the tiles of changed blocks
+        charts = {chart.name: chart for chart in self.charts}
+        with concurrent.futures.ThreadPoolExecutor(chart_threads) as pool:
+            diffs = dict(zip(changed, pool.map(lambda name: charts[name].diff(old[name]) if name in old else None, changed)))
+
+        self.dirty = [set() for _ in self.levels]
+        for name in changed:
+            chart = charts[name]
+            if diffs[name] is not None:
+                self.dirty[chart.zoom] |= chart.changed_tiles(self.levels[chart.zoom], diffs[name])
+            else:
+                self.dirty[chart.zoom] |= self.tile_sets[name]
+        for name in changed + removed:
+            if name in old and diffs.get(name) is None:
+                self.dirty[old[name]['zoom']] |= decode_tiles(old[name]['tiles'])
+        for zoom in range(len(self.levels)-1, 0, -1):
+            self.dirty[zoom-1] |= {(tx >> 1, ty >> 1) for tx, ty in self.dirty[zoom]}
+
+        store = self.levels[0].store
+        for zoom, tiles in enumerate(self.dirty):
+            store.delete(zoom, tiles)
+            self.levels[0].coverage.discard(zoom, tiles)
+        self.levels[0].coverage.restore()
+
+        charts = self.restrict()
+        print(f"{self.kind}: {len(changed)} charts changed, {len(removed)} removed, {sum(len(tiles) for tiles in self.dirty):,} dirty tiles from {len(charts)} charts")
+        return charts
+
+    # the charts that cover dirty tiles, limited to those tiles
+    def restrict(self):
+        charts = []
+        for chart in self.charts:
+            chart.only = self.tile_sets[chart.name] & self.dirty[chart.zoom]
+            if len(chart.only) > 0:
+                charts.append(chart)
+        return charts
+
+    #
+    # Resume a build in the stage where it stopped. In a stage of charts, the tiles
+    # of the charts that were not done, and the shared tiles, are deleted. They are
+    # made again from the pass of the pyramid that led up to the stage, which does
+    # not count as a stage of the build.
+    #
+    def resume(self):
+        done = self.manifest['stage']
+        previous = self.stages[done-1] if done > 0 else None
+        self.stages = self.stages[done:]
+        if len(self.stages) == 0 or self.stages[0][0] != 'charts':
+            return
+
+        _, zoom, charts = self.stages[0]
+        level = self.levels[zoom]
+        tile_sets = {chart.name: chart.tile_set(level) for chart in charts}
+        counts = {}
+        for tiles in tile_sets.values():
+            for txy in tiles:
+                counts[txy] = counts.get(txy, 0) + 1
+        redo = {txy for txy, count in counts.items() if count > 1}
+        for chart in charts:
+            if chart.name not in self.manifest['charts']:
+                redo |= tile_sets[chart.name]
+        level.store.delete(zoom, redo)
+        level.coverage.discard(zoom, redo)
 
         for chart in charts:
-            inq.put(('chart', chart))
+            chart.only = tile_sets[chart.name] & redo
+        stages = [('charts', zoom, [chart for chart in charts if len(chart.only) > 0])]
+        if previous is not None and previous[0] == 'pyramid' and previous[2] == zoom:
+            dirty = [set() for _ in self.levels]
+            dirty[zoom] = redo
+            stages.insert(0, ('pyramid', previous[1], zoom, dirty))
+            self.repairs = 1
+        self.stages = stages + self.stages[1:]
+        print(f"{self.kind}: {len(redo):,} tiles at zoom {zoom} to make again")
+
+    # the source tiles of a pyramid pass, given dirty tiles only those below a dirty
+    # tile of the pass, and the deleted tiles so that their parents are made again
+    def pyramid_tiles(self, src_zoom, dst_zoom, dirty=None):
+        tiles = self.levels[src_zoom].tiles()
+        if dirty is None:
+            return tiles
+        keep = numpy.zeros(len(tiles), dtype=bool)
+        for zoom in range(src_zoom, dst_zoom-1, -1):
+            shift = src_zoom - zoom
+            codes = numpy.array(list(dirty[zoom]), dtype='int64').reshape(-1, 2)
+            keep |= numpy.isin(util.morton_code(tiles[:,0] >> shift, tiles[:,1] >> shift), util.morton_code(codes[:,0], codes[:,1]))
+        codes = numpy.array(list(dirty[src_zoom]), dtype='int64').reshape(-1, 2)
+        deleted = codes[~numpy.isin(util.morton_code(codes[:,0], codes[:,1]), util.morton_code(tiles[:,0], tiles[:,1]))]
+        return numpy.concatenate((tiles[keep], deleted))
+
+    # checkpoint a chart that is done
+    def chart_done(self, name, ok):
+        if not ok:
+            self.failed.add(name)
+        if self.manifest is not None:
+            self.manifest['charts'].append(name)
+            self.manifest['failed'] = sorted(self.failed)
+            self.levels[0].save()
+            save_manifest(self.levels[0].store, self.manifest)
+
+    # checkpoint a stage that is done
+    def checkpoint(self):
+        if self.manifest is None:
+            return
+        if self.repairs > 0:
+            self.repairs -= 1
+            return
+        self.manifest['stage'] += 1
+        self.manifest['charts'] = []
+        save_manifest(self.levels[0].store, self.manifest)
+
+    # record the coverage and the charts that made the tiles, and publish the build
+    # unless charts failed
+    def finish(self):
+        if self.overwrite:
+            return
+        store = self.levels[0].store
+        self.levels[0].save()
+        save_provenance(store, len(self.levels)-1, [chart for chart in self.charts if chart.name not in self.failed], self.tile_sets)
+        if self.manifest is not None and len(self.failed) > 0:
+            save_manifest(store, {'build': self.manifest['build'], 'versions': self.manifest['versions'], 'retry': sorted(self.failed)})
+            print(f"{self.kind}: build {self.manifest['build']} not published, {len(self.failed)} charts failed: {', '.join(sorted(self.failed))}")
+        elif self.manifest is not None:
+            self.manifest['complete'] = True
+            save_manifest(store, self.manifest)
+            removed = store.prune()
+            self.live.publish(self.manifest['build'])
+            tile_store.collect_garbage(self.live.builds_root())
+            print(f"{self.kind}: published build {self.manifest['build']}, {removed} unused payloads removed")
 
-        for _ in range(nworkers):
-            inq.put(('done',))
+    def touch(self, txy):
+        self.levels[self.stage[1]].touch(txy)
+        self.ntiles += 1
 
-        # count results
-        ntiles = 0
-        for _ in range(nworkers):
-            for xy in outq.get():
-                levels[zoom].touch(xy)
-                ntiles += 1
-        print(f"updated {ntiles} tiles using {nworkers} workers")
+    def done(self):
+        return self.remaining == 0 and self.composited == self.nshared
 
 #
-# Scale tiles using multiple workers
+# The memory of the chart tasks. A worker measures the peak RSS of each chart over
+# the RSS it had before (on Linux, where the peak can be reset), and the peaks are
+# kept for the next run. A chart that was not measured is estimated from its size,
+# at the most bytes per pixel measured for any chart, or chart_bytes_per_pixel.
 #
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        with open("/proc/self/status") as f:
+            return next(int(line.split()[1])*1024 for line in f if line.startswith("VmRSS:"))
+    except (OSError, StopIteration):
+        return None
+
+def peak_rss(base):
+    if base is None:
+        return None
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1])*1024 for line in f if line.startswith("VmHWM:")) - base
+
+class ChartMemory:
+    def __init__(self, path=settings.chart_memory_file):
+        self.path = path
+        self.charts = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.charts = json.load(f)
 
-def scale_worker(inq, outq, src_zoom, dst_zoom, src_dir, dst_dir):
-    ntiles = 0
-    s = tile_size
-    n = 2**(src_zoom - dst_zoom)
-    tmp = numpy.zeros((s*n, s*n, 4), dtype='uint8')
-    while True:
-        xy = inq.get()
-        if xy[0] == 'done':
-            break
+    def bytes_per_pixel(self):
+        return max([record['peak'] / record['pixels'] for record in self.charts.values()] + [chart_bytes_per_pixel if len(self.charts) == 0 else 0])
 
-        count = 0
-        tmp[:,:,:] = 0
-        for offx in range(n):
-            for offy in range(n):
-                tx = xy[0]*n + offx
-                ty = xy[1]*n + offy
-                tile_path = os.path.join(src_dir, f"{tx}/{ty}.png")
-                if os.path.exists(tile_path):
-                    tmp[s*offy:s*offy+s, s*offx:s*offx+s] = numpy.asarray(PIL.Image.open(tile_path))
-                    count += 1
-        if count > 0:
-            #tmp = cv2.GaussianBlur(tmp, (5,5), sigmaX=1.0)
-            #tile = cv2.resize(tmp, (s, s), interpolation=cv2.INTER_AREA)
-            #tile = cv2.resize(tmp, (s, s), interpolation=cv2.INTER_LANCSOZ64)
-            tile = numpy.asarray(PIL.Image.fromarray(tmp).resize((s,s), PIL.Image.LANCZOS))
-            tile_dir = os.path.join(dst_dir, f"{xy[0]}")
-            os.makedirs(tile_dir, exist_ok=True)
-            tile_path = os.path.join(tile_dir, f"{xy[1]}.png")
-            if write_tile(tile_path, tile):
-                ntiles += 1
-
-    outq.put(ntiles)
-
-def scale_tiles(levels, src_zoom, dst_zoom, max_workers=max_scale_workers):
-    if dst_zoom < 0:
-        return
-    src_zoom = min(src_zoom, len(levels)-1)
+    def estimate(self, chart):
+        pixels = chart.width * chart.height
+        record = self.charts.get(chart.name)
+        if record is not None:
+            return record['peak'] * pixels // record['pixels']
+        return int(pixels * self.bytes_per_pixel())
 
-    ntiles = levels[dst_zoom].touched.sum()
-    if ntiles == 0:
-        return
+    # charts that are only partly tiled are not representative
+    def record(self, chart, peak):
+        if peak is not None and peak > 0 and chart.only is None:
+            self.charts[chart.name] = {'pixels': chart.width * chart.height, 'peak': peak}
 
-    print(f"scale_tiles {ntiles:,}, {src_zoom} => {dst_zoom}")
+    def save(self):
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.charts, f, indent=1, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
 
-    # fork workers
-    nworkers = max(0, min(max_workers, ntiles))
-    inq = ctx.Queue(nworkers*2)
-    outq = ctx.Queue(nworkers*2)
-    src_dir = levels[src_zoom].dir
-    dst_dir = levels[dst_zoom].dir
-    for _ in range(nworkers):
-        ctx.Process(target=scale_worker, args=(inq, outq, src_zoom, dst_zoom, src_dir, dst_dir,)).start()
+#
+# TilePool: one set of workers for all layers, started once. Each layer advances
+# through its stages, and the tasks of the stages that are ready, in all layers,
+# are handed out largest first, so that a large chart does not start last.
+# Shared tiles go to the composite workers, which also stay up for the whole run.
+# The workers report the time they spent on tasks, and the time from their start
+# until they were ready to take one. Charts are only handed out while the memory
+# they are estimated to need fits in memory_budget, a chart that does not fit
+# waits for a smaller one, and a chart is always handed out to an idle pool.
+#
+class TilePool:
+    def __init__(self, stores, max_workers=max_chart_workers, max_composers=max_composite_workers, memory_budget=chart_memory_budget):
+        self.tm = time.time()
+        self.inq = ctx.Queue()
+        self.outq = ctx.Queue()
+        self.queues = [ctx.Queue() for _ in range(max_composers)]
+        self.nworkers = max_workers
+        self.started = {}
+        for i, q in enumerate(self.queues):
+            self.start(('composer', i), composite_worker, (q, self.outq, stores))
+        for i in range(max_workers):
+            self.start(('worker', i), pool_worker, (self.inq, self.outq, stores, self.queues))
+
+        self.tasks = []
+        self.seq = 0
+        self.nqueued = 0
+        self.memory = ChartMemory()
+        self.memory_budget = memory_budget
+        self.admitted = {}
+        self.max_admitted = 0
+        self.startup = 0
+        self.work = 0
+
+    def start(self, wid, target, args):
+        self.started[wid] = time.time()
+        ctx.Process(target=target, args=(wid,) + args).start()
+
+    def push(self, size, task, memory=0):
+        heapq.heappush(self.tasks, (-size, self.seq, task, memory))
+        self.seq += 1
+
+    # keep the workers busy, with few tasks queued so that the largest go first
+    def dispatch(self):
+        waiting = []
+        while len(self.tasks) > 0 and self.nqueued < self.nworkers + 2:
+            entry = heapq.heappop(self.tasks)
+            task, memory = entry[2:]
+            if len(self.admitted) > 0 and sum(memory for _, memory in self.admitted.values()) + memory > self.memory_budget:
+                waiting.append(entry)
+                continue
+            if task[0] == 'chart':
+                self.admitted[(task[1], task[4].name)] = (task[4], memory)
+                self.max_admitted = max(self.max_admitted, sum(memory for _, memory in self.admitted.values()))
+            self.inq.put(task)
+            self.nqueued += 1
+        for entry in waiting:
+            heapq.heappush(self.tasks, entry)
+
+    def run(self, jobs):
+        self.jobs = {job.kind: job for job in jobs}
+        for job in jobs:
+            self.next_stage(job)
+        while any(job.stage is not None for job in jobs):
+            self.dispatch()
+            self.handle(self.outq.get())
+
+    def handle(self, msg):
+        updated = set()
+        if msg[0] == 'ready':
+            self.startup += msg[2] - self.started[msg[1]]
+        elif msg[0] == 'chart':
+            _, kind, name, ok, touched, seconds, peak = msg
+            chart, _ = self.admitted.pop((kind, name))
+            self.memory.record(chart, peak)
+            job = self.jobs[kind]
+            for txy in touched:
+                job.touch(txy)
+            job.chart_done(name, ok)
+            job.remaining -= 1
+            job.throughput['chart_seconds'] += seconds
+            self.nqueued -= 1
+            self.work += seconds
+            updated.add(job)
+        elif msg[0] == 'pyramid':
+            _, kind, counts, seconds = msg
+            job = self.jobs[kind]
+            tile_store.add_stats(job.counts, counts)
+            job.remaining -= 1
+            job.throughput['pyramid_seconds'] += seconds
+            self.nqueued -= 1
+            self.work += seconds
+            updated.add(job)
+        elif msg[0] == 'composited':
+            _, finished, seconds = msg
+            for kind, tx, ty, written in finished:
+                job = self.jobs[kind]
+                if written:
+                    job.touch((tx, ty))
+                job.composited += 1
+                updated.add(job)
+            self.work += seconds
+
+        for job in updated:
+            if job.done():
+                self.finish_stage(job)
+                job.checkpoint()
+                self.next_stage(job)
+
+    def next_stage(self, job):
+        while len(job.stages) > 0:
+            if self.start_stage(job, job.stages.pop(0)):
+                return
+            job.checkpoint()
+        job.stage = None
+        job.finish()
+        print(f"{job.kind}: done in {util.time_str(job.tm)}")
+
+    def start_stage(self, job, stage):
+        job.tm_stage = time.time()
+        job.ntiles = 0
+        job.nshared = 0
+        job.composited = 0
+        job.counts = {}
+        if stage[0] == 'charts':
+            _, zoom, charts = stage
+            if len(charts) == 0:
+                return False
+            level = job.levels[zoom]
+            print(f"{job.kind}: {level}")
+
+            # count the charts that cover each tile
+            tile_sets = [chart.tile_set(level) for chart in charts]
+            counts = {}
+            for tiles in tile_sets:
+                for txy in tiles:
+                    counts[txy] = counts.get(txy, 0) + 1
+            for order, (chart, tiles) in enumerate(zip(charts, tile_sets)):
+                shared = {txy: counts[txy] for txy in tiles if counts[txy] > 1}
+                self.push(chart.width * chart.height, ('chart', job.kind, zoom, order, chart, shared, job.overwrite), self.memory.estimate(chart))
+            job.remaining = len(charts)
+            job.throughput['warped'] += sum(len(tiles) for tiles in tile_sets)
+            job.nshared = sum(1 for count in counts.values() if count > 1)
+        else:
+            _, src_zoom, dst_zoom, dirty = stage
+            tiles = job.pyramid_tiles(src_zoom, dst_zoom, dirty)
+            if len(tiles) == 0:
+                return False
+            blocks = pyramid_blocks(tiles, src_zoom - dst_zoom)
+            print(f"{job.kind}: build_pyramid {len(tiles):,} tiles in {len(blocks):,} blocks, {src_zoom} => {dst_zoom}")
+            for block in blocks:
+                self.push(len(block) * tile_size * tile_size, ('pyramid', job.kind, src_zoom, dst_zoom, block))
+            job.remaining = len(blocks)
+        job.stage = stage
+        return True
 
-    # process each level
-    os.makedirs(dst_dir, exist_ok=True)
-    for xy in tqdm.tqdm(numpy.argwhere(levels[dst_zoom].touched)):
-        inq.put(xy)
-    for _ in range(nworkers):
-        inq.put(('done', None))
+    def finish_stage(self, job):
+        if job.stage[0] == 'charts':
+            job.levels[job.stage[1]].save()
+            print(f"{job.kind}: updated {job.ntiles} tiles at zoom {job.stage[1]} from {len(job.stage[2])} charts, {job.nshared} shared tiles, in {util.time_str(job.tm_stage)}")
+        else:
+            _, src_zoom, dst_zoom, _ = job.stage
+            job.throughput['built'] += sum(job.counts.values())
+            print(f"{job.kind}: built {', '.join(f'{job.counts.get(zoom, 0)} tiles at {zoom}' for zoom in range(src_zoom-1, dst_zoom-1, -1))} in {util.time_str(job.tm_stage)}")
+
+    def close(self):
+        for _ in range(self.nworkers):
+            self.inq.put(('done',))
+        for q in self.queues:
+            q.put(('done',))
+
+        stats = {}
+        nstats = 0
+        while nstats < self.nworkers + len(self.queues):
+            msg = self.outq.get()
+            if msg[0] == 'stats':
+                for kind, store_stats in msg[1].items():
+                    tile_store.add_stats(stats.setdefault(kind, tile_store.new_stats()), store_stats)
+                nstats += 1
+            else:
+                self.handle(msg)
+        for kind, store_stats in stats.items():
+            if store_stats['tiles'] > 0:
+                print(f"{kind}: stored {tile_store.stats_str(store_stats)}")
+
+        nprocs = self.nworkers + len(self.queues)
+        elapsed = time.time() - self.tm
+        print(f"pool of {nprocs} processes: startup {self.startup:.1f}s, work {self.work:.1f}s, {100*self.work/max(nprocs*elapsed, 1e-6):.0f}% busy over {util.time_str(self.tm)}")
+        print(f"charts admitted with up to {self.max_admitted/(1024*1024):.0f}MB of {self.memory_budget/(1024*1024):.0f}MB estimated")
+        self.memory.save()
+
+        throughput = load_throughput()
+        for kind, job in getattr(self, 'jobs', {}).items():
+            if job.throughput['warped'] + job.throughput['built'] > 0:
+                throughput[kind] = dict(job.throughput, tiles=stats.get(kind, {}).get('tiles', 0), bytes=stats.get(kind, {}).get('blob_bytes', 0))
+        save_throughput(throughput)
+
+# add the tiles of a chart, the shared tiles of a chart that failed are sent empty
+def tile_chart(cf, router, order, touched):
+    ok = False
+    try:
+        print(f"processing {cf}...")
+
+        # load rgba image and process notes, unless the chart is read in windows
+        if not windowed_charts or save_chart_images:
+            cf.load_rgba()
+            cf.mask()
+
+        # save tiles
+        if save_chart_tiles:
+            cf.save_tiles(router, order, touched)
+
+        # same map image (slow, for debugging only)
+        if save_chart_images:
+            cf.save(os.path.join(settings.tmp_dir, cf.name.replace(' ', '_') + ".png"))
+        ok = True
+    except:
+        print(f"{cf} failed")
+        traceback.print_exc()
+    router.finish(order)
+    return ok
+
+def pool_worker(wid, inq, outq, stores, queues):
+    outq.put(('ready', wid, time.time()))
+    levels = {}
+    while True:
+        task = inq.get()
+        if task[0] == 'done':
+            break
 
-    # count results
-    ntiles = 0
-    for _ in range(nworkers):
-        ntiles += outq.get()
-    print(f"scaled {ntiles} tiles using {nworkers} workers")
+        tm = time.time()
+        if task[0] == 'chart':
+            _, kind, zoom, order, cf, shared, overwrite = task
+            if (kind, zoom) not in levels:
+                levels[(kind, zoom)] = MapLevel(stores[kind], kind, zoom)
+            touched = []
+            base = reset_peak_rss()
+            ok = tile_chart(cf, TileRouter(levels[(kind, zoom)], overwrite, shared, queues), order, touched)
+            stores[kind].flush()
+            outq.put(('chart', kind, cf.name, ok, touched, time.time() - tm, peak_rss(base)))
+        elif task[0] == 'pyramid':
+            _, kind, src_zoom, dst_zoom, block = task
+            counts = {}
+            pyramid_block(stores[kind], src_zoom, dst_zoom, block, counts)
+            stores[kind].flush()
+            outq.put(('pyramid', kind, counts, time.time() - tm))
+
+    for store in stores.values():
+        store.close()
+    outq.put(('stats', {kind: store.stats for kind, store in stores.items()}))
+
+# composite the shared tiles, the finished tiles are reported once they are flushed, when
+# the queue is empty, or after composite_batch tiles or composite_interval seconds
+def composite_worker(wid, inq, outq, stores):
+    outq.put(('ready', wid, time.time()))
+    levels = {}
+    pending = {}
+    finished = []
+    seconds = 0
+    reported = time.time()
+    while True:
+        try:
+            task = inq.get(timeout=composite_interval)
+        except queue.Empty:
+            task = None
+        if task is not None and task[0] == 'done':
+            break
+
+        tm = time.time()
+        if task is not None:
+            _, kind, zoom, tx, ty, order, tile, count, overwrite = task
+            parts = pending.setdefault((kind, zoom, tx, ty), [])
+            parts.append((order, tile))
+            if len(parts) == count:
+                if (kind, zoom) not in levels:
+                    levels[(kind, zoom)] = MapLevel(stores[kind], kind, zoom)
+                touched = []
+                TileRouter(levels[(kind, zoom)], overwrite, {}, None).composite(tx, ty, pending.pop((kind, zoom, tx, ty)), touched)
+                finished.append((kind, tx, ty, len(touched) > 0))
+        if len(finished) > 0 and (task is None or inq.empty() or len(finished) >= composite_batch or tm - reported >= composite_interval):
+            for store in stores.values():
+                store.flush()
+            outq.put(('composited', finished, seconds + time.time() - tm))
+            finished = []
+            seconds = 0
+            reported = time.time()
+        else:
+            seconds += time.time() - tm
+
+    for store in stores.values():
+        store.close()
+    outq.put(('stats', {kind: store.stats for kind, store in stores.items()}))
+
+#
+# The georeference of the charts, kept by path and modification time, so that the
+# charts are listed without opening them. The charts that are new or changed are
+# opened by a pool of processes, the tile pool can only start once the charts of
+# the layers are known. Without save the cache is left as it was.
+#
+def read_georef(path):
+    try:
+        return ChartFile(os.path.splitext(os.path.basename(path))[0], path).georef()
+    except:
+        print(f"{path}: failed to read georeference")
+        traceback.print_exc()
+        return None
+
+def update_georefs(paths, max_workers=max_georef_workers, save=True):
+    georefs = {}
+    if os.path.exists(settings.chart_georef_file):
+        with open(settings.chart_georef_file) as f:
+            georefs = json.load(f)
+    mtimes = {path: osgeo.gdal.VSIStatL(path).mtime for path in paths}
+    missing = [path for path, mtime in mtimes.items() if georefs.get(path, {}).get('mtime') != mtime or 'content' not in georefs[path]]
+    if len(missing) > 0:
+        tm = time.time()
+        with concurrent.futures.ProcessPoolExecutor(min(max_workers, len(missing)), mp_context=ctx) as executor:
+            for path, georef in zip(missing, executor.map(read_georef, missing)):
+                if georef is not None:
+                    georefs[path] = dict(georef, mtime=mtimes[path])
+        print(f"read georeference of {len(missing)} charts in {util.time_str(tm)}")
+
+    # forget the charts that were removed
+    georefs = {path: georef for path, georef in georefs.items() if path in mtimes or osgeo.gdal.VSIStatL(path) is not None}
+    if not save:
+        return georefs
+    with open(settings.chart_georef_file + ".tmp", "w") as f:
+        json.dump(georefs, f, indent=1)
+    os.replace(settings.chart_georef_file + ".tmp", settings.chart_georef_file)
+    return georefs
 
 #
 # Decide which chart to process.
 #
-def list_charts_for_tiling(chart_list, chart, kind=None):
-    for chart_file in glob.glob(os.path.join(chart['path'], "*.tif")):
+def find_charts_for_tiling(chart, kind=None):
+    found = []
+    for chart_file in util.chart_files(chart['path']):
         filename = os.path.splitext(os.path.basename(chart_file))[0]
         if kind is not None:
             if f" {kind} " in filename:
@@ -545,189 +2218,96 @@ def list_charts_for_tiling(chart_list, chart, kind=None):
             continue
         if len(settings.chart_notes[filename]) == 0:
             continue
-        cf = ChartFile(filename, chart_file)
+        found.append((filename, chart_file, chart.get('date')))
+    return found
+
+def list_charts_for_tiling(chart_list, found, georefs={}):
+    for filename, chart_file, date in found:
+        cf = ChartFile(filename, chart_file, date, georefs.get(chart_file))
         cf.check(settings.chart_notes[filename])
         chart_list.append(cf)
 
+#
+# The layers: tile kind, title, chart table, and the kind of chart given its name
+#
+layer_jobs = [
+    ('sec', 'SEC', 'sec_list', lambda name: 'VFR Chart' if name.startswith('Caribbean') else 'SEC'),
+    ('tac', 'TAC', 'tac_list', lambda name: 'General Aviation' if name == 'Grand Canyon' else 'TAC'),
+    ('fly', 'FLY', 'tac_list', lambda name: 'Air Tour Operators' if name == 'Grand Canyon' else 'FLY'),
+    ('ifr_low', 'IFR low', 'ifr_low_list', lambda name: None),
+    ('ifr_high', 'IFR high', 'ifr_high_list', lambda name: None),
+]
+
 #
 # Main program
 #
 if __name__ == '__main__':
     ctx = multiprocessing.get_context('spawn')
     tm = time.time()
+    plan = '--plan' in sys.argv[1:]
 
     # limit processing to these areas
     if areas is not None:
         print(f"processing: {areas}")
 
-    # process SEC charts
-    if True:
-        if True and areas is None:
-            sec_dir = os.path.join(settings.tiles_dir, 'sec')
-            print(f"removing {sec_dir}")
-            if os.path.exists(sec_dir):
-                shutil.rmtree(sec_dir)
-
-        chart_list = []
-        if True:
-            for chart in settings.db.hash_table("sec_list").all():
-                if areas is None or chart['name'] in areas:
-                    if chart['name'].startswith('Caribbean'):
-                        list_charts_for_tiling(chart_list, chart, 'VFR Chart')
-                    else:
-                        list_charts_for_tiling(chart_list, chart, 'SEC')
-
-        chart_list = sorted(chart_list, key=lambda x: x.name)
-
-        if True:
-            print(f"{len(chart_list)} SEC charts")
-            for chart in chart_list:
-                print(chart)
-
-        if True:
-            levels = make_levels(settings.tiles_dir, 'sec', max_zoom)
-            for zoom in range(len(levels)-1, -1, -1):
-                if areas is None:
-                    levels[zoom].load()
-                print(levels[zoom])
-                process_charts(levels, zoom, [chart for chart in chart_list if chart.zoom == zoom], areas is not None)
-                scale_tiles(levels, zoom, zoom-1)
-
-
-    # process TAC charts
-    if True:
-        toplevel = 0
-
-        if True and areas is None:
-            tac_dir = os.path.join(settings.tiles_dir, 'tac')
-            print(f"removing {tac_dir}")
-            if os.path.exists(tac_dir):
-                shutil.rmtree(tac_dir)
-
-        chart_list = []
-        if True:
-            for chart in settings.db.hash_table("tac_list").all():
-                if areas is None or chart['name'] in areas:
-                    if chart['name'] == 'Grand Canyon':
-                        list_charts_for_tiling(chart_list, chart, 'General Aviation')
-                    else:
-                        list_charts_for_tiling(chart_list, chart, 'TAC')
-
-        chart_list = sorted(chart_list, key=lambda x: x.name)
-
-        if True:
-            print(f"{len(chart_list)} TAC charts")
-            for chart in chart_list:
-                print(chart)
-
-        if True:
-            levels = make_levels(settings.tiles_dir, 'tac', max_zoom)
-            for zoom in range(len(levels)-1, toplevel-1, -1):
-                if areas is None:
-                    levels[zoom].load()
-                print(levels[zoom])
-                process_charts(levels, zoom, [chart for chart in chart_list if chart.zoom == zoom], areas is not None)
-                scale_tiles(levels, zoom, zoom-1)
-
-    # process FLY charts
-    if True:
-        toplevel = 0
-
-        if True and areas is None:
-            fly_dir = os.path.join(settings.tiles_dir, 'fly')
-            print(f"removing {fly_dir}")
-            if os.path.exists(fly_dir):
-                shutil.rmtree(fly_dir)
-
-        chart_list = []
-        if True:
-            for chart in settings.db.hash_table("tac_list").all():
-                if areas is None or chart['name'] in areas:
-                    if chart['name'] == 'Grand Canyon':
-                        list_charts_for_tiling(chart_list, chart, 'Air Tour Operators')
-                    else:
-                        list_charts_for_tiling(chart_list, chart, 'FLY')
-
-        chart_list = sorted(chart_list, key=lambda x: x.name)
-
-        if True:
-            print(f"{len(chart_list)} FLY charts")
-            for chart in chart_list:
-                print(chart)
-
-        if True:
-            levels = make_levels(settings.tiles_dir, 'fly', max_zoom)
-            for zoom in range(len(levels)-1, toplevel-1, -1):
-                if areas is None:
-                    levels[zoom].load()
-                print(levels[zoom])
-                process_charts(levels, zoom, [chart for chart in chart_list if chart.zoom == zoom], areas is not None)
-                scale_tiles(levels, zoom, zoom-1)
-
-    # process IFR low charts
-    if True:
-        toplevel = 0
-
-        if True and areas is None:
-            ifr_low_dir = os.path.join(settings.tiles_dir, 'ifr_low')
-            print(f"removing {ifr_low_dir}")
-            if os.path.exists(ifr_low_dir):
-                shutil.rmtree(ifr_low_dir)
-
-        chart_list = []
-        if True:
-            for chart in settings.db.hash_table("ifr_low_list").all():
-                if areas is None or chart['name'] in areas:
-                    list_charts_for_tiling(chart_list, chart)
-
-        chart_list = sorted(chart_list, key=lambda x: x.name)
-
-        if True:
-            print(f"{len(chart_list)} IFR low charts")
-            for chart in chart_list:
-                print(chart)
-
-        if True:
-            levels = make_levels(settings.tiles_dir, 'ifr_low', max_zoom)
-            for zoom in range(len(levels)-1, toplevel-1, -1):
-                if areas is None:
-                    levels[zoom].load()
-                print(levels[zoom])
-                process_charts(levels, zoom, [chart for chart in chart_list if chart.zoom == zoom], areas is not None)
-                scale_tiles(levels, zoom, zoom-1)
-
-    # process IFR high charts
-    if True:
-        toplevel = 0
-
-        if True and areas is None:
-            ifr_high_dir = os.path.join(settings.tiles_dir, 'ifr_high')
-            print(f"removing {ifr_high_dir}")
-            if os.path.exists(ifr_high_dir):
-                shutil.rmtree(ifr_high_dir)
-
+    # tile stores, and the tile urls for www/map.js, a plan leaves the tiles as they are.
+    # mbtiles layers are served by a tile server at mbtiles_url, such as
+    # 'http://localhost:8080/{name}/{z}/{x}/{y}', without it they are left out of the map
+    stores = {kind: tile_store.open_store(kind, settings.tiles_dir, tile_store_type, format, encode_threads, settings.tile_builds_dir) for kind, format in layer_formats.items()}
+    if not plan:
+        tile_store.save_layers(os.path.join(settings.tiles_dir, "layers.js"), stores, settings.www_dir, mbtiles_url)
+
+        # remove the versions left in the trash by an earlier run
+        tile_store.collect_garbage(settings.tile_builds_dir)
+
+    # find the charts of each layer, and their georeference
+    found = {}
+    for kind, title, table, chart_kind in layer_jobs:
+        found[kind] = []
+        for chart in settings.db.hash_table(table).all():
+            if areas is None or chart['name'] in areas:
+                found[kind] += find_charts_for_tiling(chart, chart_kind(chart['name']))
+    georefs = update_georefs(list(dict.fromkeys(chart_file for charts in found.values() for _, chart_file, _ in charts)), save=not plan)
+
+    # list the charts of each layer
+    jobs = []
+    planned = []
+    for kind, title, table, chart_kind in layer_jobs:
         chart_list = []
-        if True:
-            for chart in settings.db.hash_table("ifr_high_list").all():
-                if areas is None or chart['name'] in areas:
-                    list_charts_for_tiling(chart_list, chart)
+        list_charts_for_tiling(chart_list, found[kind], georefs)
 
         chart_list = sorted(chart_list, key=lambda x: x.name)
 
-        if True:
-            print(f"{len(chart_list)} IFR high charts")
-            for chart in chart_list:
-                print(chart)
-
-        if True:
-            levels = make_levels(settings.tiles_dir, 'ifr_high', max_zoom)
-            for zoom in range(len(levels)-1, toplevel-1, -1):
-                if areas is None:
-                    levels[zoom].load()
-                print(levels[zoom])
-                process_charts(levels, zoom, [chart for chart in chart_list if chart.zoom == zoom], areas is not None)
-                scale_tiles(levels, zoom, zoom-1)
-
+        print(f"{len(chart_list)} {title} charts")
+        if plan:
+            planned.append(plan_layer(stores[kind], kind, chart_list, load_throughput()))
+            continue
+        for chart in chart_list:
+            print(chart)
+
+        # build the layer in a new version, or in the version of a build that was interrupted
+        live = stores[kind]
+        provenance = None
+        manifest = None
+        if areas is None:
+            stores[kind], manifest, provenance = stage_layer(live, chart_list)
+
+        levels = make_levels(stores[kind], kind, max_zoom)
+        print(f"{title}: {sum(predict_tiles(levels, chart_list).values()):,} tiles predicted")
+        if areas is None:
+            levels[0].load()
+        jobs.append(LayerJob(levels, chart_list, areas is not None, provenance, manifest, live))
+
+    if plan:
+        size = sum(size for size, _ in planned)
+        seconds = sum(seconds or 0 for _, seconds in planned)
+        print(f"planned {size/(1024*1024*1024):.1f}GB of tiles in {util.duration_str(seconds)} on {min(max_chart_workers, os.cpu_count())} workers{'' if all(seconds is not None for _, seconds in planned) else ', without the layers that were not run before'}")
+        sys.exit(0)
+
+    # process all layers with one pool of workers
+    pool = TilePool(stores)
+    pool.run(jobs)
+    pool.close()
 
     tm = math.floor(time.time() - tm)
     hrs = tm // 3600
@@ -33,7 +33,13 @@ if not os.path.exists(elevations_dir):
 
 nasr_dir = os.path.join(charts_source_dir, "NASR")
 cloudahoy_dir = os.path.join(data_dir, "cloudahoy")
+chart_cache_dir = os.path.join(data_dir, "chart_cache")
+chart_diffs_dir = os.path.join(data_dir, "chart_diffs")
+chart_memory_file = os.path.join(data_dir, "chart_memory.json")
+chart_georef_file = os.path.join(data_dir, "chart_georef.json")
+chart_throughput_file = os.path.join(data_dir, "chart_throughput.json")
 tiles_dir = os.path.join(www_dir, "tiles")
+tile_builds_dir = os.path.join(data_dir, "tile_builds")
 sec_tiles_dir = os.path.join(tiles_dir, "sec")
 tac_tiles_dir = os.path.join(tiles_dir, "tac")
 airports_dir = os.path.join(tiles_dir, "airports")
@@ -0,0 +1,547 @@
+# (c)2022, Artfahrt Inc, Arthur van Hoff
+# Tile stores for the chart tiler. A store holds the encoded tiles of one
+# layer and is pickled to the workers, each of which opens it for itself.
+# Identical tiles (transparent margins, open water, ...) are stored once,
+# keyed by the hash of their encoding.
+
+import os, io, json, time, shutil, sqlite3, hashlib, collections, concurrent.futures, threading, numpy, PIL.Image
+
+#
+# Tile formats. A format without alpha writes the tiles at the edges of the charts,
+# which are not opaque, in its alpha format, 'jpeg' writes JPEG for opaque tiles
+# and PNG for the others. Each tile has the extension of its real format, and the
+# MBTiles metadata has the format of the layer. Layers in png or jpeg also take
+# 'indexed' tiles, PNGs with the palette of the chart. The options are passed to PIL.
+#
+formats = ['png', 'webp', 'webp-lossy', 'jpeg']
+indexed_formats = ['png', 'jpeg']
+alpha_formats = {'jpeg': 'png'}
+format_ext = {'png': 'png', 'webp': 'webp', 'webp-lossy': 'webp', 'jpeg': 'jpg', 'indexed': 'png'}
+encoder_options = {
+    'png': {'format': 'PNG', 'compress_level': 6},
+    'webp': {'format': 'WEBP', 'lossless': True, 'quality': 80, 'method': 4},
+    'webp-lossy': {'format': 'WEBP', 'quality': 85, 'method': 4},
+    'jpeg': {'format': 'JPEG', 'quality': 85},
+    'indexed': {'format': 'PNG', 'compress_level': 6},
+}
+
+# encode an rgba tile, or a tile of palette indices with an rgb palette
+def encode_tile(tile, format='png', palette=None):
+    tm = time.time()
+    if palette is not None:
+        format = 'indexed'
+        image = PIL.Image.fromarray(tile)
+        image.putpalette(palette.tobytes(), 'RGB')
+    else:
+        if format in alpha_formats and not tile[:,:,3].all():
+            format = alpha_formats[format]
+        image = PIL.Image.fromarray(tile[:,:,:3] if format == 'jpeg' else tile)
+    out = io.BytesIO()
+    image.save(out, **encoder_options[format])
+    return format, out.getvalue(), time.time() - tm
+
+def decode_tile(data):
+    return numpy.asarray(PIL.Image.open(io.BytesIO(data)).convert('RGBA'))
+
+def tile_digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+def new_stats():
+    return {'tiles': 0, 'bytes': 0, 'blobs': 0, 'blob_bytes': 0, 'cached': 0}
+
+def add_stats(total, stats):
+    for key, value in stats.items():
+        total[key] = total.get(key, 0) + value
+    return total
+
+def stats_str(stats):
+    tiles = max(1, stats['tiles'])
+    result = f"{stats['tiles']} tiles, {stats['blobs']} stored ({100*stats['blobs']/tiles:.1f}%), {stats['bytes']/max(1, stats['blob_bytes']):.2f}x dedupe, {stats['cached']} encodes skipped"
+    for format in formats + ['indexed']:
+        n = stats.get(f"{format}_tiles", 0)
+        if n > 0:
+            result += f", {format} {n} x {stats[f'{format}_bytes']/n/1024:.1f}KB in {1000*stats[f'{format}_time']/n:.1f}ms"
+    return result
+
+#
+# TileStore: encoding and deduplication shared by the stores. Recently written
+# tiles are remembered by the hash of their pixels, so that a repeated tile is
+# linked to the stored payload without encoding it again. With encode_threads
+# the tiles are encoded by a thread pool and written in order as they complete,
+# the tiles passed to write_tile must not be modified afterwards. A tile that is
+# repeated while it is being encoded waits for the same encoding.
+#
+class TileStore:
+    def __init__(self, format='png', encode_threads=0, cache_size=1024):
+        assert format in formats, f"unknown tile format {format}"
+        self.format = format
+        self.indexed = format in indexed_formats
+        self.encode_threads = encode_threads
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.stats = new_stats()
+        self.pool = None
+        self.encoding = collections.deque()
+        self.encodes = {}
+        self.builds_base = None
+
+    # the cache, the encoder pool and the stats are per process
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['cache'] = collections.OrderedDict()
+        state['stats'] = new_stats()
+        state['pool'] = None
+        state['encoding'] = collections.deque()
+        state['encodes'] = {}
+        return state
+
+    def read_tile(self, z, x, y):
+        self.drain()
+        data = self.read(z, x, y)
+        return decode_tile(data) if data is not None else None
+
+    # write an rgba tile, or a tile of palette indices when palette is given
+    def write_tile(self, z, x, y, tile, palette=None):
+        key = hashlib.blake2b(numpy.ascontiguousarray(tile), digest_size=16)
+        if palette is not None:
+            key.update(numpy.ascontiguousarray(palette))
+        key = key.digest()
+        if self.write_cached(z, x, y, key):
+            return
+        if self.encode_threads > 0:
+            if self.pool is None:
+                self.pool = concurrent.futures.ThreadPoolExecutor(self.encode_threads)
+            if key not in self.encodes:
+                self.encodes[key] = self.pool.submit(encode_tile, tile, self.format, palette)
+            self.encoding.append((z, x, y, key, self.encodes[key]))
+            if len(self.encoding) > 2*self.encode_threads:
+                self.write_encoded(*self.encoding.popleft())
+        else:
+            self.write_encoded(z, x, y, key, encode_tile(tile, self.format, palette))
+
+    # link a tile to the payload of a recent tile with the same pixels
+    def write_cached(self, z, x, y, key):
+        if key not in self.cache:
+            return False
+        digest, size, ext = self.cache[key]
+        if not self.write(z, x, y, None, digest, ext):
+            return False
+        self.cache.move_to_end(key)
+        self.stats['tiles'] += 1
+        self.stats['bytes'] += size
+        self.stats['cached'] += 1
+        return True
+
+    def write_encoded(self, z, x, y, key, result):
+        self.encodes.pop(key, None)
+        if self.write_cached(z, x, y, key):
+            return
+        format, data, seconds = result.result() if isinstance(result, concurrent.futures.Future) else result
+        digest = tile_digest(data)
+        self.write(z, x, y, data, digest, format_ext[format])
+        self.cache[key] = (digest, len(data), format_ext[format])
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        self.stats['tiles'] += 1
+        self.stats['bytes'] += len(data)
+        add_stats(self.stats, {f"{format}_tiles": 1, f"{format}_bytes": len(data), f"{format}_time": seconds})
+
+    # write the tiles that are still being encoded
+    def drain(self):
+        while len(self.encoding) > 0:
+            self.write_encoded(*self.encoding.popleft())
+
+    def stored(self, data):
+        self.stats['blobs'] += 1
+        self.stats['blob_bytes'] += len(data)
+
+    def close_pool(self):
+        self.drain()
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    #
+    # Builds: a layer is built in a new version, <builds>/<kind>/<build>, and
+    # published by pointing the layer, which is a symlink, at the version. The
+    # builds are kept outside the served tiles, in builds_base, or <base>/.builds
+    # by default. The versions that are replaced are moved to <builds>/.trash,
+    # and removed in the background by collect_garbage.
+    #
+    def builds_root(self):
+        return self.builds_base or os.path.join(os.path.dirname(self.path), ".builds")
+
+    def builds_dir(self):
+        return os.path.join(self.builds_root(), os.path.basename(self.path))
+
+    def builds(self):
+        return sorted(os.listdir(self.builds_dir())) if os.path.isdir(self.builds_dir()) else []
+
+    # the store of a build
+    def version(self, build):
+        return self.at(self.version_path(build))
+
+    # the build that is live, None for a layer that was not published from a build
+    def published(self):
+        if not os.path.islink(self.path):
+            return None
+        return os.path.relpath(os.path.realpath(self.path), os.path.realpath(self.builds_dir())).split(os.sep)[0]
+
+    def publish(self, build):
+        tmp = self.path + f".new_{os.getpid()}"
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        os.symlink(os.path.relpath(self.version_path(build), os.path.dirname(self.path)), tmp)
+        if os.path.lexists(self.path) and not os.path.islink(self.path):
+            self.trash(self.legacy_paths())
+        os.replace(tmp, self.path)
+        for other in self.builds():
+            if other != build:
+                self.discard(other)
+
+    def discard(self, build):
+        self.trash([os.path.join(self.builds_dir(), build)])
+
+    def trash(self, paths):
+        trash_dir = os.path.join(self.builds_root(), ".trash", f"{os.path.basename(self.path)}-{time.time():.6f}")
+        os.makedirs(trash_dir)
+        for path in paths:
+            shutil.move(path, os.path.join(trash_dir, os.path.basename(path)))
+
+#
+# DirectoryTileStore: one file per tile, <path>/<z>/<x>/<y>.<ext>. The payloads
+# are kept in <path>/.blobs by hash and the tiles are hardlinks to them, or
+# symlinks where hardlinks are not possible (link count limit, filesystem).
+# A tile of a layer with an alpha format is in one of the two extensions.
+#
+class DirectoryTileStore(TileStore):
+    def __init__(self, path, format='png', encode_threads=0):
+        super().__init__(format, encode_threads)
+        self.path = path
+        self.ext = format_ext[format]
+        self.exts = [self.ext] + ([format_ext[alpha_formats[format]]] if format in alpha_formats else [])
+
+    def tile_path(self, z, x, y, ext=None):
+        return os.path.join(self.path, f"{z}", f"{x}", f"{y}.{ext or self.ext}")
+
+    def blob_path(self, digest, ext=None):
+        return os.path.join(self.path, ".blobs", digest[:2], f"{digest}.{ext or self.ext}")
+
+    # the url templates of the extensions, the browser tries them in order
+    def url_template(self, base, server=None):
+        urls = [os.path.relpath(self.path, base) + f"/{{z}}/{{x}}/{{y}}.{ext}" for ext in self.exts]
+        return urls[0] if len(urls) == 1 else urls
+
+    def coverage_path(self):
+        return os.path.join(self.path, ".coverage.npz")
+
+    def provenance_path(self):
+        return os.path.join(self.path, ".provenance.json")
+
+    def manifest_path(self):
+        return os.path.join(self.path, ".manifest.json")
+
+    def version_path(self, build):
+        return os.path.join(self.builds_dir(), build)
+
+    def at(self, path):
+        store = DirectoryTileStore(path, self.format, self.encode_threads)
+        store.builds_base = self.builds_base
+        return store
+
+    def legacy_paths(self):
+        return [self.path]
+
+    # copy the tiles to another store, as hardlinks to the same files
+    def copy_to(self, store):
+        shutil.copytree(self.path, store.path, symlinks=True, copy_function=os.link)
+
+    # remove the payloads that no tile links to
+    def prune(self):
+        blobs_dir = os.path.join(self.path, ".blobs")
+        used = set()
+        for dir_name, dirs, files in os.walk(self.path):
+            if dir_name == self.path and '.blobs' in dirs:
+                dirs.remove('.blobs')
+            for file_name in files:
+                path = os.path.join(dir_name, file_name)
+                used.add(os.path.realpath(path) if os.path.islink(path) else os.lstat(path).st_ino)
+        removed = 0
+        for dir_name, _, files in os.walk(blobs_dir):
+            for file_name in files:
+                path = os.path.join(dir_name, file_name)
+                if os.lstat(path).st_ino not in used and os.path.realpath(path) not in used:
+                    os.remove(path)
+                    removed += 1
+        return removed
+
+    def read(self, z, x, y):
+        for ext in self.exts:
+            path = self.tile_path(z, x, y, ext)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    return f.read()
+        return None
+
+    # write a tile, data may be None when the payload is already stored, the tile
+    # in the other extension of the layer is removed
+    def write(self, z, x, y, data, digest=None, ext=None):
+        if digest is None:
+            digest = tile_digest(data)
+        ext = ext or self.ext
+        blob = self.blob_path(digest, ext)
+        if not os.path.exists(blob):
+            if data is None:
+                return False
+            blob_dir = os.path.dirname(blob)
+            os.makedirs(blob_dir, exist_ok=True)
+            new_blob = os.path.join(blob_dir, f".new_{os.getpid()}_{digest}")
+            with open(new_blob, 'wb') as out:
+                out.write(data)
+            os.replace(new_blob, blob)
+            self.stored(data)
+
+        path = self.tile_path(z, x, y, ext)
+        dir_name, file_name = os.path.split(path)
+        os.makedirs(dir_name, exist_ok=True)
+        new_path = os.path.join(dir_name, ".new_" + file_name)
+        if os.path.lexists(new_path):
+            os.remove(new_path)
+        try:
+            os.link(blob, new_path)
+        except OSError:
+            os.symlink(os.path.relpath(blob, dir_name), new_path)
+        os.replace(new_path, path)
+        for other in self.exts:
+            if other != ext and os.path.lexists(self.tile_path(z, x, y, other)):
+                os.remove(self.tile_path(z, x, y, other))
+        return True
+
+    # remove tiles, their payloads stay in the blobs
+    def delete(self, z, tiles):
+        for x, y in tiles:
+            for ext in self.exts:
+                path = self.tile_path(z, x, y, ext)
+                if os.path.lexists(path):
+                    os.remove(path)
+
+    def tiles(self, z):
+        zoom_dir = os.path.join(self.path, f"{z}")
+        if not os.path.exists(zoom_dir):
+            return
+        for x in os.listdir(zoom_dir):
+            if x[0] != '.':
+                for y in os.listdir(os.path.join(zoom_dir, x)):
+                    if y[0] != '.':
+                        yield int(x), int(y.split('.')[0])
+
+    def flush(self):
+        self.drain()
+
+    def close(self):
+        self.close_pool()
+
+    def clear(self):
+        if os.path.islink(self.path):
+            os.remove(self.path)
+        elif os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+    # hardlinked tiles are counted once
+    def disk_usage(self):
+        inodes = {}
+        for dir_name, _, files in os.walk(self.path):
+            for file_name in files:
+                st = os.lstat(os.path.join(dir_name, file_name))
+                inodes[st.st_ino] = st.st_blocks * 512
+        return sum(inodes.values())
+
+    def __str__(self):
+        return f"DirectoryTileStore({self.path})"
+
+#
+# MBTilesStore: all tiles of a layer in one SQLite file (MBTiles 1.3, TMS rows).
+# Writes are buffered and inserted in batched transactions, the database runs in
+# WAL mode so that the workers can read while others write. Payloads are stored
+# once in the images table, with their real format, the map table points the
+# tiles at them and the tiles view presents the standard MBTiles layout to readers.
+#
+class MBTilesStore(TileStore):
+    def __init__(self, path, name=None, format='png', encode_threads=0, batch_size=256):
+        super().__init__(format, encode_threads)
+        self.path = path
+        self.name = name or os.path.splitext(os.path.basename(path))[0]
+        self.batch_size = batch_size
+        self.db = None
+        self.pending = {}
+        self.images = {}
+
+    # the connection is per process
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['db'] = None
+        state['pending'] = {}
+        state['images'] = {}
+        return state
+
+    def connect(self):
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self.db = sqlite3.connect(self.path, timeout=600, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)")
+            self.db.execute("CREATE UNIQUE INDEX IF NOT EXISTS metadata_index ON metadata (name)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT)")
+            self.db.execute("CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (zoom_level, tile_column, tile_row)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS images (tile_id TEXT, tile_data BLOB, tile_format TEXT)")
+            self.db.execute("CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id)")
+            if 'tile_format' not in [row[1] for row in self.db.execute("PRAGMA table_info(images)")]:
+                self.db.execute("ALTER TABLE images ADD COLUMN tile_format TEXT")
+            self.db.execute("CREATE VIEW IF NOT EXISTS tiles AS SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, map.tile_row AS tile_row, images.tile_data AS tile_data FROM map JOIN images ON images.tile_id = map.tile_id")
+            self.db.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)", [('name', self.name), ('format', format_ext[self.format])])
+        return self.db
+
+    # sqlite does not match numpy integers, so coordinates are normalized
+    def read(self, z, x, y):
+        z, x, y = int(z), int(x), int(y)
+        if (z, x, y) in self.pending:
+            digest = self.pending[(z, x, y)]
+            if digest in self.images:
+                return self.images[digest][0]
+            row = self.connect().execute("SELECT tile_data FROM images WHERE tile_id=?", (digest,)).fetchone()
+        else:
+            row = self.connect().execute("SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?", (z, x, (1 << z) - 1 - y)).fetchone()
+        return row[0] if row is not None else None
+
+    # write a tile, data may be None when the payload was written by this process
+    def write(self, z, x, y, data, digest=None, ext=None):
+        if digest is None:
+            digest = tile_digest(data)
+        if data is not None:
+            self.images[digest] = (data, ext or format_ext[self.format])
+        self.pending[(int(z), int(x), int(y))] = digest
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        return True
+
+    def delete(self, z, tiles):
+        self.flush()
+        db = self.connect()
+        db.execute("BEGIN IMMEDIATE")
+        db.executemany("DELETE FROM map WHERE zoom_level=? AND tile_column=? AND tile_row=?", [(int(z), int(x), (1 << int(z)) - 1 - int(y)) for x, y in tiles])
+        db.execute("COMMIT")
+
+    def tiles(self, z):
+        self.flush()
+        for x, row in self.connect().execute("SELECT tile_column, tile_row FROM map WHERE zoom_level=?", (z,)):
+            yield x, (1 << z) - 1 - row
+
+    def flush(self):
+        self.drain()
+        if len(self.pending) > 0:
+            db = self.connect()
+            db.execute("BEGIN IMMEDIATE")
+            for digest, (data, ext) in self.images.items():
+                if db.execute("INSERT OR IGNORE INTO images (tile_id, tile_data, tile_format) VALUES (?, ?, ?)", (digest, data, ext)).rowcount > 0:
+                    self.stored(data)
+            db.executemany("INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)",
+                           [(z, x, (1 << z) - 1 - y, digest) for (z, x, y), digest in self.pending.items()])
+            db.execute("COMMIT")
+            self.pending = {}
+            self.images = {}
+
+    def coverage_path(self):
+        return self.path + ".coverage.npz"
+
+    def provenance_path(self):
+        return self.path + ".provenance.json"
+
+    def manifest_path(self):
+        return self.path + ".manifest.json"
+
+    def version_path(self, build):
+        return os.path.join(self.builds_dir(), build, os.path.basename(self.path))
+
+    def at(self, path):
+        store = MBTilesStore(path, self.name, self.format, self.encode_threads, self.batch_size)
+        store.builds_base = self.builds_base
+        return store
+
+    def legacy_paths(self):
+        return [self.path + suffix for suffix in ('', '-wal', '-shm', '.coverage.npz', '.provenance.json') if os.path.exists(self.path + suffix)]
+
+    # copy the database with the sqlite backup, and the index files next to it
+    def copy_to(self, store):
+        self.flush()
+        os.makedirs(os.path.dirname(store.path), exist_ok=True)
+        db = sqlite3.connect(store.path)
+        self.connect().backup(db)
+        db.close()
+        for suffix in ('.coverage.npz', '.provenance.json'):
+            if os.path.exists(self.path + suffix):
+                shutil.copy2(self.path + suffix, store.path + suffix)
+
+    def prune(self):
+        self.flush()
+        return self.connect().execute("DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)").rowcount
+
+    # mbtiles layers are served by a tile server, not from www, server is its url
+    # template with the name of the layer as {name}
+    def url_template(self, base, server=None):
+        return server.replace('{name}', self.name) if server is not None else None
+
+    def close(self):
+        self.close_pool()
+        self.flush()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def clear(self):
+        self.close()
+        for suffix in ('', '-wal', '-shm', '.coverage.npz', '.provenance.json', '.manifest.json'):
+            if os.path.lexists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def disk_usage(self):
+        return sum(os.stat(self.path + suffix).st_blocks * 512 for suffix in ('', '-wal', '-shm') if os.path.exists(self.path + suffix))
+
+    def __str__(self):
+        return f"MBTilesStore({self.path})"
+
+# remove the versions in the trash of the builds, in a thread that the program waits for when it exits
+def collect_garbage(builds):
+    trash_dir = os.path.join(builds, ".trash")
+
+    def remove():
+        tm = time.time()
+        names = os.listdir(trash_dir) if os.path.isdir(trash_dir) else []
+        for name in names:
+            shutil.rmtree(os.path.join(trash_dir, name), ignore_errors=True)
+        if len(names) > 0:
+            print(f"removed {len(names)} old versions in {time.time() - tm:.1f}s")
+    thread = threading.Thread(target=remove)
+    thread.start()
+    return thread
+
+def open_store(kind, base, store_type='dir', format='png', encode_threads=0, builds_base=None):
+    if store_type == 'mbtiles':
+        store = MBTilesStore(os.path.join(base, kind + ".mbtiles"), kind, format, encode_threads)
+    else:
+        store = DirectoryTileStore(os.path.join(base, kind), format, encode_threads)
+    store.builds_base = builds_base
+    return store
+
+#
+# Write the tile url templates of the layers, relative to www, for www/map.js. A layer
+# without a url, an mbtiles layer without a tile server, is null and is left out of the map.
+#
+def save_layers(path, stores, www_dir, server=None):
+    with open(path, 'w') as out:
+        out.write("// generated by chart_tiler.py\n")
+        out.write("tile_layers = {\n")
+        for kind, store in stores.items():
+            out.write(f"    '{kind}': {json.dumps(store.url_template(www_dir, server))},\n")
+        out.write("};\n")
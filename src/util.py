@@ -1,6 +1,6 @@
 # (c)2019, Arthur van Hoff
 
-import os, sys, requests, math, shapely, shapely.geometry, shapely.ops, numpy, hashlib, time
+import os, sys, glob, json, requests, math, shapely, shapely.geometry, shapely.ops, numpy, hashlib, time
 from scipy import optimize
 import settings
 
@@ -181,7 +181,9 @@ def enumerate_triples(points):
         p1 = p2
 
 def time_str(tm):
-    tm = time.time() - tm
+    return duration_str(time.time() - tm)
+
+def duration_str(tm):
     if tm < 60:
         return f"{tm:.3f}s"
     tm = math.floor(tm)
@@ -190,6 +192,31 @@ def time_str(tm):
     sec = (tm % 60)
     return f"{hrs}:{min:02}:{sec:02}"
 
+#
+# Morton (Z-order) codes of tile coordinates, x in the even bits and y in the odd
+# bits, so that the base 4 digits of a code are the quadkey of the tile.
+# Works on ints and on numpy arrays.
+#
+
+def morton_spread(v):
+    v = numpy.asarray(v, dtype='uint64') & numpy.uint64(0xffffffff)
+    for shift, mask in ((16, 0x0000ffff0000ffff), (8, 0x00ff00ff00ff00ff), (4, 0x0f0f0f0f0f0f0f0f), (2, 0x3333333333333333), (1, 0x5555555555555555)):
+        v = (v | (v << numpy.uint64(shift))) & numpy.uint64(mask)
+    return v
+
+def morton_compact(v):
+    v = numpy.asarray(v, dtype='uint64') & numpy.uint64(0x5555555555555555)
+    for shift, mask in ((1, 0x3333333333333333), (2, 0x0f0f0f0f0f0f0f0f), (4, 0x00ff00ff00ff00ff), (8, 0x0000ffff0000ffff), (16, 0x00000000ffffffff)):
+        v = (v | (v >> numpy.uint64(shift))) & numpy.uint64(mask)
+    return v
+
+def morton_code(x, y):
+    return morton_spread(x) | (morton_spread(y) << numpy.uint64(1))
+
+def morton_decode(code):
+    code = numpy.asarray(code, dtype='uint64')
+    return morton_compact(code).astype('int64'), morton_compact(code >> numpy.uint64(1)).astype('int64')
+
 
 #
 # Given a complex polygon construct a list of simple
@@ -228,6 +255,31 @@ def polygon_list(poly):
 def polygon_intersection(p1, p2):
     return polygon_list(p1.difference(p2)), polygon_list(p1.intersection(p2)), polygon_list(p2.difference(p1))
 
+#
+# The TIF files of a chart, in its directory, or in its zip file when the chart
+# was installed as a zip. The index of a zip lists its members, the TIF files are
+# read by GDAL through /vsizip/.
+#
+
+chart_index = "index.json"
+
+def save_chart_index(path, zip_path, zip):
+    index = {
+        'zip': os.path.basename(zip_path),
+        'members': {info.filename: {'size': info.file_size, 'crc': info.CRC} for info in zip.infolist()},
+    }
+    with open(os.path.join(path, chart_index + ".tmp"), "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(os.path.join(path, chart_index + ".tmp"), os.path.join(path, chart_index))
+
+def chart_files(path):
+    if os.path.exists(os.path.join(path, chart_index)):
+        with open(os.path.join(path, chart_index)) as f:
+            index = json.load(f)
+        zip_path = os.path.abspath(os.path.join(path, index['zip']))
+        return [f"/vsizip/{zip_path}/{name}" for name in index['members'] if name.endswith(".tif")]
+    return glob.glob(os.path.join(path, "*.tif"))
+
 #
 # Download a file
 #
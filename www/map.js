@@ -29,36 +29,27 @@ if (params.get('debug') != null) {
     debug();
 }
 
-sec_layer = new Cesium.UrlTemplateImageryProvider({
-    url : 'tiles/sec/{z}/{x}/{y}.png',
-    credit : 'Artfahrt Inc',
-    hasAlphaChannel: true,
-    maximumLevel: 13,
-});
-viewer.scene.imageryLayers.addImageryProvider(sec_layer);
-
-tac_layer = new Cesium.UrlTemplateImageryProvider({
-    url : 'tiles/tac/{z}/{x}/{y}.png',
-    credit : 'Artfahrt Inc',
-    hasAlphaChannel: true,
-    //minimumLevel: 8,
-    maximumLevel: 13,
-});
-viewer.scene.imageryLayers.addImageryProvider(tac_layer);
+// the chart layers, from tiles.js
+function tileLayer(kind)
+{
+    let provider = tileProvider(kind, {
+        credit : 'Artfahrt Inc',
+        hasAlphaChannel: true,
+        maximumLevel: 13,
+    });
+    if (provider === null) {
+        return null;
+    }
+    let layer = viewer.scene.imageryLayers.addImageryProvider(provider);
+    layer.show = false;
+    return layer;
+}
 
-fly_layer = new Cesium.UrlTemplateImageryProvider({
-    url : 'tiles/fly/{z}/{x}/{y}.png',
-    credit : 'Artfahrt Inc',
-    hasAlphaChannel: true,
-    //minimumLevel: 8,
-    maximumLevel: 13,
-});
-viewer.scene.imageryLayers.addImageryProvider(fly_layer);
+sec_layer = tileLayer('sec');
+tac_layer = tileLayer('tac');
+fly_layer = tileLayer('fly');
 
 viewer.scene.imageryLayers.get(0).show = false;
-viewer.scene.imageryLayers.get(1).show = false;
-viewer.scene.imageryLayers.get(2).show = false;
-viewer.scene.imageryLayers.get(3).show = false;
 viewer.scene.globe.depthTestAgainstTerrain = true;
 viewer.scene.globe.terrainExaggeration = 1.0;
 
@@ -107,17 +98,17 @@ function showLayer(name, on)
             showAirport(airport, true, false);
         }
     } else if (name == 'SEC') {
-        viewer.scene.imageryLayers.get(1).show = on;
+        if (sec_layer) sec_layer.show = on;
     } else if (name == 'TAC') {
-        viewer.scene.imageryLayers.get(2).show = on;
+        if (tac_layer) tac_layer.show = on;
         if (on) {
-            viewer.scene.imageryLayers.get(3).show = false;
+            if (fly_layer) fly_layer.show = false;
             $('#FLY').prop('checked', false)
         }
     } else if (name == 'FLY') {
-        viewer.scene.imageryLayers.get(3).show = on;
+        if (fly_layer) fly_layer.show = on;
         if (on) {
-            viewer.scene.imageryLayers.get(2).show = false;
+            if (tac_layer) tac_layer.show = false;
             $('#TAC').prop('checked', false)
         }
    } else if (name == 'TERRAIN') {
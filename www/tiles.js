@@ -0,0 +1,33 @@
+// (c)2022 Artfahrt Inc.
+
+// the tile urls of a layer, as written by chart_tiler.py to tiles/layers.js, a layer
+// that is null is not available
+function tileUrls(kind)
+{
+    if (typeof tile_layers !== 'undefined' && kind in tile_layers) {
+        let urls = tile_layers[kind];
+        return urls === null || Array.isArray(urls) ? urls : [urls];
+    }
+    return ['tiles/' + kind + '/{z}/{x}/{y}.png'];
+}
+
+// the imagery of a layer, the tiles of a jpeg layer at the edges of the charts are
+// png, they are requested when there is no jpg tile
+function tileProvider(kind, options)
+{
+    let urls = tileUrls(kind);
+    if (urls === null) {
+        console.log("layer not available", kind);
+        return null;
+    }
+    let providers = urls.map(url => new Cesium.UrlTemplateImageryProvider(Object.assign({url : url}, options)));
+    let requestImage = providers[0].requestImage.bind(providers[0]);
+    providers[0].requestImage = function(x, y, level, request) {
+        let image = requestImage(x, y, level, request);
+        for (let provider of providers.slice(1)) {
+            image = image && image.then(undefined, () => provider.requestImage(x, y, level));
+        }
+        return image;
+    };
+    return providers[0];
+}